@@ -0,0 +1,291 @@
+import resource
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from courses.models import Course, Lesson, EnrollmentRequest, TeachingInvitation
+from courses.utils import bulk_insert
+
+PASSWORD = 'benchmark'
+
+# Pending requests consumed per iteration: one by each single response 
+# scenario and one by each bulk response scenario
+REQUEST_SLOTS = 6
+
+# Sizes of the synthetic dataset
+DEFAULT_SIZES = {
+    'courses': 20,
+    'lessons': 10,
+    'students': 200,
+    'teachers': 5,
+    'requests': 100,
+    'invitations': 100,
+}
+
+def _create_users(prefix, count, is_staff=False):
+    """
+    Creates ``count`` users sharing the benchmark password with one INSERT,
+    returning them in order.
+    """
+    user = User(username='hash')
+    user.set_password(PASSWORD)
+    now = datetime.now()
+    bulk_insert(User, ('username', 'first_name', 'last_name', 'email',
+                       'password', 'is_staff', 'is_active', 'is_superuser',
+                       'last_login', 'date_joined'),
+                [('%s%d' % (prefix, i), '', '', '', user.password, is_staff, 
+                  True, False, now, now) for i in range(count)])
+    return list(User.objects.filter(username__startswith=prefix
+        ).order_by('pk'))
+
+def seed(courses, lessons, students, teachers, requests, invitations):
+    """
+    Fills the database with a synthetic dataset and returns a dictionary of
+    the objects which the scenarios refer to. The first course is moderated,
+    and collects the pending enrollment requests and teaching invitations.
+    """
+    teacher_list = _create_users('bench-teacher-', teachers)
+    student_list = _create_users('bench-student-', students)
+    requestor_list = _create_users('bench-requestor-', requests)
+    invitee_list = _create_users('bench-invitee-', invitations)
+    staff = _create_users('bench-staff-', 1, is_staff=True)[0]
+    course_list = []
+    for i in range(courses):
+        course = Course(title='Benchmark course %d' % i,
+                        description='A course for benchmarking',
+                        moderated=(i == 0),
+                        activated=datetime.now())
+        course.save()
+        for teacher in teacher_list:
+            course.appoint_teacher(teacher)
+        course.enroll_many(student_list)
+        course.add_lessons([Lesson(title='Lesson %d.%d' % (i, j),
+                                   description='A lesson for benchmarking')
+                            for j in range(lessons)])
+        course_list.append(course)
+    moderated, owner = course_list[0], teacher_list[0]
+    for requestor in requestor_list:
+        EnrollmentRequest(requestor=requestor, course=moderated,
+                          status="R").save()
+    moderated.invite_teachers(owner, invitee_list)
+    return {
+        'course': moderated,
+        'other_course': course_list[-1],
+        'lesson': moderated.outline()[0],
+        'teacher': owner,
+        'staff': staff,
+        'student': student_list[0],
+        'requests': list(EnrollmentRequest.objects.filter(course=moderated)),
+        'invitations': list(TeachingInvitation.objects.filter(course=moderated
+            ).select_related('invitee')),
+    }
+
+def scenarios(data):
+    """
+    Returns ``(name, method, user, path, post_data)`` tuples driving every
+    named URL in ``courses.urls``. ``path`` and ``post_data`` are functions
+    of the iteration number, so that endpoints which consume a pending
+    request or invitation get a fresh one each time, and ``user`` may be
+    too.
+    """
+    course, lesson = data['course'].slug, data['lesson'].slug
+    teacher, student = data['teacher'], data['student']
+    requests, invitations = data['requests'], data['invitations']
+
+    def url(name, **kwargs):
+        return lambda i: reverse(name, kwargs=kwargs)
+
+    def nothing(i):
+        return {}
+
+    result = [
+        ('course_list', 'get', None, url('course_list'), nothing),
+        ('course_create', 'get', teacher, url('course_create'), nothing),
+        ('course_detail', 'get', student, url('course_detail', course_slug=course), nothing),
+        ('course_edit', 'get', teacher, url('course_edit', course_slug=course), nothing),
+        ('course_lesson_create', 'get', teacher,
+            url('course_lesson_create', course_slug=course), nothing),
+        ('course_lesson_detail', 'get', student,
+            url('course_lesson_detail', course_slug=course, lesson_slug=lesson), nothing),
+        ('course_lesson_edit', 'get', teacher,
+            url('course_lesson_edit', course_slug=course, lesson_slug=lesson), nothing),
+        ('course_enrollment_request_list', 'get', teacher,
+            url('course_enrollment_request_list'), nothing),
+        ('course_teachership', 'get', teacher,
+            url('course_teachership', course_slug=course, action='invite'), nothing),
+        ('course_search', 'get', student, url('course_search'),
+            lambda i: {'q': 'benchmark'}),
+        ('course_query_stats', 'get', data['staff'], url('course_query_stats'), 
+            nothing),
+        ('course_actions', 'post', teacher,
+            url('course_actions', course_slug=course, action='activate'), nothing),
+        ('course_enrollment', 'post', student,
+            url('course_enrollment', course_slug=data['other_course'].slug,
+                action='enroll'), nothing),
+        ('course_lesson_actions', 'post', teacher,
+            url('course_lesson_actions', course_slug=course, lesson_slug=lesson,
+                action='activate'), nothing),
+        ('course_enrollment_response', 'get', teacher,
+            lambda i: reverse('course_enrollment_response', kwargs={
+                'enrollment_request_uuid': requests[REQUEST_SLOTS * i].uuid,
+                'action': 'accept'}), nothing),
+        ('course_teachership_response', 'get', 
+            lambda i: invitations[3 * i].invitee,
+            lambda i: reverse('course_teachership_response', kwargs={
+                'teachership_invitation_uuid': invitations[3 * i].uuid,
+                'action': 'decline'}), nothing),
+        ('course_enrollment_responses', 'post', teacher,
+            url('course_enrollment_responses', action='accept'),
+            lambda i: {'requests': [requests[REQUEST_SLOTS * i + 3].uuid]}),
+    ]
+    for format in ('json', 'xml'):
+        result.extend([
+            ('course_list_ajax.%s' % format, 'get', None,
+                url('course_list_ajax', ajax=format), nothing),
+            ('course_search_ajax.%s' % format, 'get', student,
+                url('course_search_ajax', ajax=format),
+                lambda i: {'q': 'benchmark'}),
+            ('course_enrollment_request_list_ajax.%s' % format, 'get', teacher,
+                url('course_enrollment_request_list_ajax', ajax=format), nothing),
+            ('course_actions_ajax.%s' % format, 'post', teacher,
+                url('course_actions_ajax', course_slug=course, action='activate',
+                    ajax=format), nothing),
+            ('course_enrollment_ajax.%s' % format, 'post', student,
+                url('course_enrollment_ajax', course_slug=data['other_course'].slug,
+                    action='enroll', ajax=format), nothing),
+            ('course_teachership_ajax.%s' % format, 'post', teacher,
+                url('course_teachership_ajax', course_slug=course,
+                    action='invite', ajax=format),
+                lambda i: {'teachers': []}),
+            ('course_roster_export.%s' % format, 'get', teacher,
+                url('course_roster_export', course_slug=course, ajax=format), 
+                nothing),
+            ('course_teacher_candidates_ajax.%s' % format, 'get', teacher,
+                url('course_teacher_candidates_ajax', course_slug=course,
+                    ajax=format), lambda i: {'q': 'bench'}),
+            ('course_lesson_actions_ajax.%s' % format, 'post', teacher,
+                url('course_lesson_actions_ajax', course_slug=course,
+                    lesson_slug=lesson, action='activate', ajax=format), nothing),
+        ])
+        offset = format == 'json' and 1 or 2
+        result.extend([
+            ('course_enrollment_response_ajax.%s' % format, 'get', teacher,
+                lambda i, offset=offset, format=format: reverse(
+                    'course_enrollment_response_ajax', kwargs={
+                        'enrollment_request_uuid': requests[REQUEST_SLOTS * i + offset].uuid,
+                        'action': 'decline', 'ajax': format}), nothing),
+            ('course_enrollment_responses_ajax.%s' % format, 'post', teacher,
+                url('course_enrollment_responses_ajax', action='decline', 
+                    ajax=format),
+                lambda i, offset=offset: {'requests': [
+                    requests[REQUEST_SLOTS * i + 3 + offset].uuid]}),
+            ('course_teachership_response_ajax.%s' % format, 'get', 
+                lambda i, offset=offset: invitations[3 * i + offset].invitee,
+                lambda i, offset=offset, format=format: reverse(
+                    'course_teachership_response_ajax', kwargs={
+                        'teachership_invitation_uuid': invitations[3 * i + offset].uuid,
+                        'action': 'decline', 'ajax': format}), nothing),
+        ])
+    return result
+
+def _rss_kb():
+    """
+    Returns the current resident set size in kilobytes, or the peak where the
+    current size can't be read.
+    """
+    try:
+        statm = open('/proc/self/statm')
+        try:
+            pages = int(statm.read().split()[1])
+        finally:
+            statm.close()
+        return pages * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _percentile(timings, percent):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * percent / 100.0))]
+
+def run(iterations=20, warmup=2, **sizes):
+    """
+    Seeds a dataset of the given ``sizes`` and requests every scenario
+    ``warmup`` times unmeasured, then ``iterations`` times, returning a
+    dictionary of results by scenario name. Timings are in milliseconds and
+    memory is the most the resident set grew, in kilobytes, over the 
+    scenario's measured requests.
+    """
+    sizes = dict(DEFAULT_SIZES, **sizes)
+    sizes['requests'] = max(sizes['requests'], 
+                            REQUEST_SLOTS * (iterations + warmup))
+    sizes['invitations'] = max(sizes['invitations'], 3 * (iterations + warmup))
+    data = seed(**sizes)
+    debug, settings.DEBUG = settings.DEBUG, True
+    results = {}
+    try:
+        for name, method, user, path, post_data in scenarios(data):
+            client, logged_in = Client(), None
+            timings, queries, statuses, rss = [], [], {}, []
+            for i in range(warmup + iterations):
+                current = user
+                if callable(user):
+                    current = user(i)
+                if current and current != logged_in:
+                    client.login(username=current.username, password=PASSWORD)
+                    logged_in = current
+                if i == warmup:
+                    rss_before = _rss_kb()
+                connection.queries = []
+                start = time.time()
+                try:
+                    response = getattr(client, method)(path(i), post_data(i))
+                    status = str(response.status_code)
+                except Exception, e:
+                    status = e.__class__.__name__
+                elapsed = (time.time() - start) * 1000
+                if i >= warmup:
+                    rss.append(_rss_kb())
+                    timings.append(elapsed)
+                    queries.append(len(connection.queries))
+                    statuses[status] = statuses.get(status, 0) + 1
+            results[name] = {
+                'p50': _percentile(timings, 50),
+                'p90': _percentile(timings, 90),
+                'p99': _percentile(timings, 99),
+                'mean': sum(timings) / len(timings),
+                'queries': max(queries),
+                'rss_growth_kb': max(0, max(rss) - rss_before),
+                'statuses': statuses,
+            }
+    finally:
+        settings.DEBUG = debug
+    return {'sizes': sizes, 'iterations': iterations, 'results': results}
+
+def compare(results, baseline, time_threshold=1.5, query_threshold=0):
+    """
+    Returns a list of messages describing regressions in ``results`` against
+    ``baseline``: a median time more than ``time_threshold`` times the
+    baseline, more than ``query_threshold`` extra queries, or responses 
+    with different statuses, such as a 200 turning into a 500.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        base = baseline['results'].get(name)
+        if not base:
+            continue
+        if result['p50'] > base['p50'] * time_threshold:
+            regressions.append("%s: median %.1fms against %.1fms" %
+                               (name, result['p50'], base['p50']))
+        if result['queries'] > base['queries'] + query_threshold:
+            regressions.append("%s: %d queries against %d" %
+                               (name, result['queries'], base['queries']))
+        if sorted(result['statuses']) != sorted(base['statuses']):
+            regressions.append("%s: statuses %s against %s" % (name, 
+                ", ".join(sorted(result['statuses'])), 
+                ", ".join(sorted(base['statuses']))))
+    return sorted(regressions)
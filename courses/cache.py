@@ -0,0 +1,133 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache as default_cache, get_cache
+
+COURSE_ROLE_CACHE_ENABLED = getattr(settings, 'COURSE_ROLE_CACHE_ENABLED', False)
+COURSE_ROLE_CACHE_BACKEND = getattr(settings, 'COURSE_ROLE_CACHE_BACKEND', None)
+COURSE_ROLE_CACHE_TIMEOUT = getattr(settings, 'COURSE_ROLE_CACHE_TIMEOUT', 300)
+
+# Version keys must outlive the entries they guard
+VERSION_TIMEOUT = 60 * 60 * 24 * 30
+
+TEACHER, OWNER, STUDENT = 1, 2, 4
+
+# Built once, as each get_cache call makes a new client, and a new private
+# store for locmem
+if COURSE_ROLE_CACHE_BACKEND:
+    _role_backend = get_cache(COURSE_ROLE_CACHE_BACKEND)
+else:
+    _role_backend = default_cache
+
+def get_backend():
+    return _role_backend
+
+def _new_version():
+    # Seeded from the clock so that a version key which has been evicted
+    # can't come back with a number that matches an old entry
+    return int(time.time() * 1000)
+
+### Role cache ###
+
+def _role_version_key(course_id, user_id):
+    return "courses.roles.version.%s.%s" % (course_id, user_id)
+
+def _role_key(course_id, user_id, version):
+    return "courses.roles.%s.%s.v%s" % (course_id, user_id, version)
+
+def get_roles(course_id, user_id):
+    """
+    Returns a ``(bits, version)`` pair for the user in the course. ``bits``
+    is ``None`` if caching is disabled or nothing current is cached, in which
+    case the caller should compute the roles and hand them to ``set_roles``
+    along with ``version``, so that a role change which lands in between
+    can't be overwritten by the stale result.
+    """
+    if not COURSE_ROLE_CACHE_ENABLED:
+        return None, None
+    backend = get_backend()
+    version_key = _role_version_key(course_id, user_id)
+    version = backend.get(version_key)
+    if version is None:
+        backend.add(version_key, _new_version(), VERSION_TIMEOUT)
+        version = backend.get(version_key)
+        return None, version
+    return backend.get(_role_key(course_id, user_id, version)), version
+
+def set_roles(course_id, user_id, bits, version):
+    if not COURSE_ROLE_CACHE_ENABLED or version is None:
+        return
+    get_backend().set(_role_key(course_id, user_id, version), bits,
+                      COURSE_ROLE_CACHE_TIMEOUT)
+
+def invalidate_roles(course_id, user_id):
+    """
+    Bumps the version for the user in the course so that any entry cached
+    before the role change can no longer be read.
+    """
+    if not COURSE_ROLE_CACHE_ENABLED:
+        return
+    backend = get_backend()
+    version_key = _role_version_key(course_id, user_id)
+    try:
+        backend.incr(version_key)
+    except ValueError:
+        backend.set(version_key, _new_version(), VERSION_TIMEOUT)
+
+### Course fragment cache ###
+
+COURSE_FRAGMENT_CACHE_ENABLED = getattr(settings, 'COURSE_FRAGMENT_CACHE_ENABLED', False)
+COURSE_FRAGMENT_CACHE_BACKEND = getattr(settings, 'COURSE_FRAGMENT_CACHE_BACKEND', None)
+COURSE_FRAGMENT_CACHE_TIMEOUT = getattr(settings, 'COURSE_FRAGMENT_CACHE_TIMEOUT', 600)
+
+if COURSE_FRAGMENT_CACHE_BACKEND:
+    _fragment_backend = get_cache(COURSE_FRAGMENT_CACHE_BACKEND)
+else:
+    _fragment_backend = default_cache
+
+def get_fragment_backend():
+    return _fragment_backend
+
+def _generation_key(course_id):
+    return "courses.generation.%s" % course_id
+
+def _fragment_key(course_id, generation, name):
+    return "courses.fragment.%s.g%s.%s" % (course_id, generation, name)
+
+def get_fragment(course_id, name):
+    """
+    Returns a ``(value, generation)`` pair for the named fragment of the 
+    course. ``value`` is ``None`` if caching is disabled or the fragment 
+    isn't cached for the course's current generation, in which case the 
+    caller should build it and hand it to ``set_fragment`` with 
+    ``generation``.
+    """
+    if not COURSE_FRAGMENT_CACHE_ENABLED:
+        return None, None
+    backend = get_fragment_backend()
+    generation_key = _generation_key(course_id)
+    generation = backend.get(generation_key)
+    if generation is None:
+        backend.add(generation_key, _new_version(), VERSION_TIMEOUT)
+        return None, backend.get(generation_key)
+    return backend.get(_fragment_key(course_id, generation, name)), generation
+
+def set_fragment(course_id, name, value, generation):
+    if not COURSE_FRAGMENT_CACHE_ENABLED or generation is None:
+        return
+    get_fragment_backend().set(_fragment_key(course_id, generation, name), 
+                               value, COURSE_FRAGMENT_CACHE_TIMEOUT)
+
+def bump_generation(course_id):
+    """
+    Moves the course on to a new generation, so that every fragment cached 
+    for it is dropped at once without having to find their keys.
+    """
+    if not COURSE_FRAGMENT_CACHE_ENABLED:
+        return
+    backend = get_fragment_backend()
+    generation_key = _generation_key(course_id)
+    try:
+        backend.incr(generation_key)
+    except ValueError:
+        backend.set(generation_key, _new_version(), VERSION_TIMEOUT)
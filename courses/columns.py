@@ -0,0 +1,54 @@
+from django.db import connection, transaction
+
+from courses.models import Course, Lesson
+
+# Columns added to the app's tables since they were first created, as 
+# (model, field names). syncdb creates them with the tables of new databases,
+# but not on tables which already exist.
+COLUMNS = (
+    (Course, ('student_count', 'lesson_count', 'pending_request_count')),
+    (Course, ('activate_at', 'deactivate_at')),
+    (Lesson, ('activate_at', 'deactivate_at')),
+)
+
+def column_exists(cursor, table, column):
+    return column in [row[0] for row in 
+                      connection.introspection.get_table_description(cursor, table)]
+
+def _db_type(field):
+    try:
+        return field.db_type(connection=connection)
+    except TypeError:
+        # Before Django 1.2 fields don't take the connection
+        return field.db_type()
+
+@transaction.commit_on_success
+def add_columns(verbosity=1):
+    """
+    Adds whichever of ``COLUMNS`` don't exist yet, along with the indexes of
+    fields with ``db_index``, returning their names. Columns which can't be 
+    null start out with the field's default. Safe to run repeatedly.
+    """
+    cursor, qn, added = connection.cursor(), connection.ops.quote_name, []
+    for model, field_names in COLUMNS:
+        table = model._meta.db_table
+        for field_name in field_names:
+            field = model._meta.get_field(field_name)
+            if column_exists(cursor, table, field.column):
+                continue
+            definition = _db_type(field)
+            if not field.null:
+                definition += " NOT NULL DEFAULT %s" % field.get_default()
+            cursor.execute("ALTER TABLE %s ADD COLUMN %s %s" % (qn(table), 
+                qn(field.column), definition))
+            if field.db_index:
+                # Named as syncdb names the indexes of new tables
+                cursor.execute("CREATE INDEX %s ON %s (%s)" % (
+                    qn('%s_%s' % (table, field.column)), qn(table), 
+                    qn(field.column)))
+            transaction.set_dirty()
+            name = "%s.%s" % (table, field.column)
+            added.append(name)
+            if verbosity:
+                print "Added column %s" % name
+    return added
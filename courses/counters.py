@@ -0,0 +1,80 @@
+from django.db import transaction
+from django.db.models import Count
+
+from courses.models import Course, Enrollment, EnrollmentRequest, Lesson
+from courses.routers import primary_connection
+
+# The denormalized counters on ``Course``, as (field name, model counted, 
+# filter on the counted rows)
+COUNTERS = (
+    ('student_count', Enrollment, {'is_active': True}),
+    ('lesson_count', Lesson, {}),
+    ('pending_request_count', EnrollmentRequest, {'status': 'R'}),
+)
+
+def _counts(model, filters):
+    # Cleared ordering, as default ordering fields would join the GROUP BY
+    rows = model.objects.filter(**filters).order_by().values('course'
+        ).annotate(count=Count('pk'))
+    return dict([(row['course'], row['count']) for row in rows])
+
+def find_drift():
+    """
+    Recomputes every counter with one grouped COUNT per counter, returning a
+    list of ``(course_id, field name, stored, actual)`` for those which are 
+    off.
+    """
+    actual = [(name, _counts(model, filters)) 
+              for name, model, filters in COUNTERS]
+    names = [name for name, model, filters in COUNTERS]
+    drift = []
+    for row in Course.objects.values_list('pk', *names).iterator():
+        for (name, counts), stored in zip(actual, row[1:]):
+            if stored != counts.get(row[0], 0):
+                drift.append((row[0], name, stored, counts.get(row[0], 0)))
+    return drift
+
+# Most courses recounted per UPDATE, within SQLite's 999 parameter limit
+RECOUNT_BATCH_SIZE = 500
+
+@transaction.commit_on_success
+def recount(course_ids):
+    """
+    Sets the counters of the given courses to the current counts with an
+    UPDATE of correlated subqueries per ``RECOUNT_BATCH_SIZE`` courses.
+    """
+    course_ids = list(course_ids)
+    for start in range(0, len(course_ids), RECOUNT_BATCH_SIZE):
+        _recount(course_ids[start:start + RECOUNT_BATCH_SIZE])
+
+def _recount(course_ids):
+    connection = primary_connection()
+    qn = connection.ops.quote_name
+    opts = Course._meta
+    assignments, params = [], []
+    for name, model, filters in COUNTERS:
+        where = ["%s = %s.%s" % (qn(model._meta.get_field('course').column), 
+                                 qn(opts.db_table), qn(opts.pk.column))]
+        for field_name, value in filters.items():
+            where.append("%s = %%s" % 
+                         qn(model._meta.get_field(field_name).column))
+            params.append(value)
+        assignments.append("%s = (SELECT COUNT(*) FROM %s WHERE %s)" % (
+            qn(opts.get_field(name).column), qn(model._meta.db_table), 
+            " AND ".join(where)))
+    connection.cursor().execute("UPDATE %s SET %s WHERE %s IN (%s)" % (
+        qn(opts.db_table), ", ".join(assignments), qn(opts.pk.column), 
+        ", ".join(["%s"] * len(course_ids))), params + list(course_ids))
+    transaction.set_dirty()
+
+def reconcile(fix=True):
+    """
+    Finds the counters which have drifted from the rows they count, e.g. 
+    through admin edits or lost concurrent updates, and recounts the courses
+    concerned unless ``fix`` is false. Returns the drift found.
+    """
+    drift = find_drift()
+    if fix:
+        recount(sorted(set([course_id for course_id, name, stored, actual 
+                            in drift])))
+    return drift
@@ -0,0 +1,144 @@
+import base64
+import hashlib
+import hmac
+
+from django.conf import settings
+from django.utils import simplejson
+
+# A dotted path to the ``FeedbackBackend`` subclass which carries messages 
+# from a view to the next page the user sees
+COURSE_FEEDBACK_BACKEND = getattr(settings, 'COURSE_FEEDBACK_BACKEND', 
+                                  'courses.feedback.CookieBackend')
+COURSE_FEEDBACK_COOKIE = getattr(settings, 'COURSE_FEEDBACK_COOKIE', 
+                                 'courses_feedback')
+COURSE_FEEDBACK_SESSION_KEY = '_courses_feedback'
+
+# Browsers may drop larger cookies, so the oldest messages are dropped first
+MAX_COOKIE_SIZE = 2048
+
+
+class FeedbackBackend(object):
+    """
+    The interface for feedback backends: ``load`` returns the messages 
+    pending for the user making ``request`` and ``store`` records those 
+    still pending once it has been handled.
+    """
+    def load(self, request):
+        raise NotImplementedError
+
+    def store(self, request, response, messages):
+        raise NotImplementedError
+
+
+class CookieBackend(FeedbackBackend):
+    """
+    Keeps pending messages in a cookie signed with ``SECRET_KEY``, so that 
+    neither showing nor leaving a message touches the database.
+    """
+    def _signature(self, value):
+        return hmac.new(settings.SECRET_KEY + 'courses.feedback', value, 
+                        hashlib.sha1).hexdigest()
+
+    def load(self, request):
+        data = request.COOKIES.get(COURSE_FEEDBACK_COOKIE)
+        if not data or ':' not in data:
+            return []
+        value, signature = data.rsplit(':', 1)
+        if not _constant_time_compare(signature, self._signature(value)):
+            return []
+        try:
+            return simplejson.loads(base64.urlsafe_b64decode(value))
+        except (TypeError, ValueError):
+            return []
+
+    def store(self, request, response, messages):
+        if not messages:
+            if COURSE_FEEDBACK_COOKIE in request.COOKIES:
+                response.delete_cookie(COURSE_FEEDBACK_COOKIE)
+            return
+        while True:
+            value = base64.urlsafe_b64encode(simplejson.dumps(messages))
+            if len(value) <= MAX_COOKIE_SIZE or len(messages) == 1:
+                break
+            messages = messages[1:]
+        response.set_cookie(COURSE_FEEDBACK_COOKIE, 
+                            "%s:%s" % (value, self._signature(value)))
+
+
+class SessionBackend(FeedbackBackend):
+    """
+    Keeps pending messages in the session, for messages too many or too 
+    long for a cookie. What that costs depends on the session engine.
+    """
+    def load(self, request):
+        return list(request.session.get(COURSE_FEEDBACK_SESSION_KEY, []))
+
+    def store(self, request, response, messages):
+        if messages:
+            request.session[COURSE_FEEDBACK_SESSION_KEY] = messages
+        elif COURSE_FEEDBACK_SESSION_KEY in request.session:
+            del request.session[COURSE_FEEDBACK_SESSION_KEY]
+
+
+def _constant_time_compare(a, b):
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+_backend = None
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        module, name = COURSE_FEEDBACK_BACKEND.rsplit('.', 1)
+        _backend = getattr(__import__(module, {}, {}, [name]), name)()
+    return _backend
+
+def _pending(request):
+    if not hasattr(request, '_course_feedback'):
+        request._course_feedback = get_backend().load(request)
+        request._course_feedback_changed = False
+    return request._course_feedback
+
+def add(request, message):
+    """
+    Leaves ``message`` for the next page shown to the user making 
+    ``request``, whether or not they're logged in.
+    """
+    # Collapse the runs of spaces left by continued string literals
+    _pending(request).append(u" ".join(unicode(message).split()))
+    request._course_feedback_changed = True
+
+def pending(request):
+    """
+    Returns whether there are messages pending for the user, without 
+    clearing them.
+    """
+    return bool(_pending(request))
+
+def get_messages(request):
+    """
+    Returns the messages pending for the user and clears them.
+    """
+    messages = _pending(request)
+    if messages:
+        request._course_feedback = []
+        request._course_feedback_changed = True
+    return messages
+
+def context_processor(request):
+    """
+    Puts the pending messages in the template context as ``feedback``.
+    """
+    return {'feedback': get_messages(request)}
+
+def process_response(request, response):
+    """
+    Stores the messages left pending by the request, if they changed.
+    """
+    if getattr(request, '_course_feedback_changed', False):
+        get_backend().store(request, response, request._course_feedback)
+    return response
@@ -1,14 +1,30 @@
+from django import forms
 from django.forms import ModelForm
 from models import Course, Lesson
 
+def _clean_schedule(cleaned_data):
+    activate_at = cleaned_data.get('activate_at')
+    deactivate_at = cleaned_data.get('deactivate_at')
+    if activate_at and deactivate_at and deactivate_at <= activate_at:
+        raise forms.ValidationError("The deactivation time must come after "
+                                    "the activation time")
+    return cleaned_data
+
 
 class CourseForm(ModelForm): 
     class Meta:
         model = Course
-        fields = ('title', 'description', 'privacy', 'moderated')
+        fields = ('title', 'description', 'privacy', 'moderated', 'activate_at', 
+                  'deactivate_at')
+        
+    def clean(self):
+        return _clean_schedule(self.cleaned_data)
 
 
 class LessonForm(ModelForm):   
     class Meta:
         model = Lesson
-        fields = ('title', 'description',)
+        fields = ('title', 'description', 'activate_at', 'deactivate_at')
+        
+    def clean(self):
+        return _clean_schedule(self.cleaned_data)
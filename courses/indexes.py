@@ -0,0 +1,56 @@
+from django.db import connection, transaction
+
+from courses.models import Course, Enrollment, EnrollmentRequest, Lesson, \
+    Teachership
+from courses.utils import db_vendor
+
+# Composite indexes for the hot filters, as (name, model, field names). Each
+# leads with the columns compared for equality and ends with those used for 
+# ranges, ordering or to cover the rest of the query.
+INDEXES = (
+    ('courses_enrollment_course_active', Enrollment, 
+        ('course', 'is_active', 'student')),
+    ('courses_teachership_course_active', Teachership, 
+        ('course', 'is_active', 'teacher')),
+    ('courses_teachership_teacher_active', Teachership, 
+        ('teacher', 'is_active', 'course')),
+    ('courses_enrollmentrequest_course_status', EnrollmentRequest, 
+        ('course', 'status', 'created')),
+    ('courses_lesson_course_activated', Lesson, ('course', 'activated')),
+    ('courses_course_activated_id', Course, ('activated', 'id')),
+)
+
+def index_exists(cursor, name, table):
+    vendor = db_vendor(connection)
+    if vendor == 'sqlite':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+                       "AND name = %s", [name])
+    elif vendor == 'postgresql':
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s", [name])
+    elif vendor == 'mysql':
+        cursor.execute("SHOW INDEX FROM %s WHERE Key_name = %%s" % 
+                       connection.ops.quote_name(table), [name])
+    else:
+        return False
+    return bool(cursor.fetchall())
+
+@transaction.commit_on_success
+def create_indexes(verbosity=1):
+    """
+    Creates whichever of ``INDEXES`` don't exist yet, returning their names. 
+    Safe to run repeatedly, so it serves both new and existing databases.
+    """
+    cursor, qn, created = connection.cursor(), connection.ops.quote_name, []
+    for name, model, field_names in INDEXES:
+        table = model._meta.db_table
+        if index_exists(cursor, name, table):
+            continue
+        columns = [model._meta.get_field(field_name).column 
+                   for field_name in field_names]
+        cursor.execute("CREATE INDEX %s ON %s (%s)" % (qn(name), qn(table), 
+            ", ".join([qn(column) for column in columns])))
+        transaction.set_dirty()
+        created.append(name)
+        if verbosity:
+            print "Created index %s" % name
+    return created
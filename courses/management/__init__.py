@@ -1,4 +1,5 @@
 from django.db.models import signals, get_app
+from courses import models as courses_app
 from django.core.exceptions import ImproperlyConfigured
 
 from django.utils.translation import ugettext_noop as _
@@ -13,7 +14,21 @@ try:
         notification.create_notice_type("course_student_request", _("Request to Enroll"), _("someone has requested to enroll in a course that you teach"))
         notification.create_notice_type("course_student_acceptance", _("Accepted Request to Enroll"), _("your request to enroll in a course has been accepted"))
         notification.create_notice_type("course_student_rejection", _("Declined Request to Enroll"), _("your request to enroll in a course has been declined"))
+        notification.create_notice_type("course_activated", _("Course Activated"), _("a course you teach or are enrolled in has been activated"))
+        notification.create_notice_type("course_lesson_activated", _("Lesson Activated"), _("a lesson has been activated in a course you are enrolled in"))
 
     signals.post_syncdb.connect(create_notice_types, sender=notification) 
 except ImproperlyConfigured:
-    print "Skipping creation of NoticeTypes as notification app not found"
\ No newline at end of file
+    print "Skipping creation of NoticeTypes as notification app not found"
+
+def create_course_indexes(app, created_models, verbosity, **kwargs):
+    from courses.indexes import create_indexes
+    create_indexes(verbosity=int(verbosity))
+
+signals.post_syncdb.connect(create_course_indexes, sender=courses_app)
+
+def create_course_search_table(app, created_models, verbosity, **kwargs):
+    from courses.search import create_table
+    create_table()
+
+signals.post_syncdb.connect(create_course_search_table, sender=courses_app)
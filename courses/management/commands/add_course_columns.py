@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+
+from courses import counters
+from courses.columns import add_columns
+
+
+class Command(NoArgsCommand):
+    help = ('Adds the columns of the courses app which are missing from the '
+            'tables of an existing database, then recounts the course '
+            'counters. New databases get them at syncdb.')
+
+    def handle_noargs(self, **options):
+        if not add_columns(verbosity=int(options.get('verbosity', 1))):
+            print "All columns already exist"
+        # New counter columns start at zero
+        print "Corrected %d counters" % len(counters.reconcile())
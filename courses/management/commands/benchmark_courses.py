@@ -0,0 +1,72 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import simplejson
+
+from courses import benchmark
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + tuple([
+        make_option('--%s' % name, dest=name, type='int', default=default,
+            help='Number of %s in the synthetic dataset. Defaults to %d.' % 
+                 (name, default)) 
+        for name, default in sorted(benchmark.DEFAULT_SIZES.items())
+    ]) + (
+        make_option('--iterations', dest='iterations', type='int', default=20,
+            help='Measured requests per endpoint. Defaults to 20.'),
+        make_option('--warmup', dest='warmup', type='int', default=2,
+            help='Unmeasured requests per endpoint first. Defaults to 2.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the results to as JSON.'),
+        make_option('--baseline', dest='baseline', default=None,
+            help='JSON results of an earlier run to compare against.'),
+        make_option('--time-threshold', dest='time_threshold', type='float', 
+            default=1.5, help='Ratio to the baseline median time above which '
+                              'an endpoint has regressed. Defaults to 1.5.'),
+        make_option('--query-threshold', dest='query_threshold', type='int', 
+            default=0, help='Extra queries over the baseline allowed before an '
+                            'endpoint has regressed. Defaults to 0.'),
+    )
+    help = ('Benchmarks every courses URL against a synthetic dataset in a '
+            'throwaway SQLite test database.')
+
+    def handle(self, **options):
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            raise CommandError("The benchmark runs against SQLite only")
+        baseline = None
+        if options.get('baseline'):
+            baseline = simplejson.load(open(options['baseline']))
+        sizes = dict([(name, options[name]) for name in benchmark.DEFAULT_SIZES])
+        
+        old_name = settings.DATABASE_NAME
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            results = benchmark.run(iterations=options['iterations'], 
+                                    warmup=options['warmup'], **sizes)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        
+        for name, result in sorted(results['results'].items()):
+            print "%-45s p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  %4d queries  " \
+                "+%6dkB  %s" % (
+                name, result['p50'], result['p90'], result['p99'], 
+                result['queries'], result['rss_growth_kb'], 
+                ", ".join(["%s x%d" % item for item in 
+                           sorted(result['statuses'].items())]))
+        if options.get('output'):
+            output = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, output, indent=2, sort_keys=True)
+            finally:
+                output.close()
+        if baseline:
+            regressions = benchmark.compare(results, baseline, 
+                time_threshold=options['time_threshold'], 
+                query_threshold=options['query_threshold'])
+            if regressions:
+                raise CommandError("Regressions against %s:\n%s" % 
+                                   (options['baseline'], "\n".join(regressions)))
+            print "No regressions against %s" % options['baseline']
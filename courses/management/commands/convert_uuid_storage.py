@@ -0,0 +1,141 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from courses.models import EnrollmentRequest, TeachingInvitation, \
+    COURSE_UUID_STORAGE
+from courses.utils import UUIDField, db_vendor, commit_on_success_unless_managed
+
+MODELS = (EnrollmentRequest, TeachingInvitation)
+PHASES = ('add', 'backfill', 'swap')
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='Rows to convert per transaction. Defaults to 1000.'),
+        make_option('--pause', dest='pause', type='float', default=0,
+            help='Seconds to sleep between batches, to leave room for other '
+                 'writers. Defaults to 0.'),
+    )
+    help = ('Converts the text UUID keys of enrollment requests and teaching '
+            'invitations to native storage, in three phases which may be run '
+            'separately: "add" adds a column for the converted keys, '
+            '"backfill" fills it in short batches while the site runs, and '
+            '"swap" briefly locks each table to convert stragglers and make '
+            'the new column the primary key. Run all three with no arguments, '
+            'with COURSE_UUID_STORAGE set to "char", and set it to "native" '
+            'as soon as the swap is done.')
+    args = '[%s]' % '|'.join(PHASES)
+
+    def handle(self, *phases, **options):
+        for phase in phases:
+            if phase not in PHASES:
+                raise CommandError("Unknown phase \"%s\"" % phase)
+        if COURSE_UUID_STORAGE == 'native':
+            raise CommandError("COURSE_UUID_STORAGE is already \"native\"; "
+                "the site must keep writing text keys until the swap")
+        for phase in phases or PHASES:
+            for model in MODELS:
+                getattr(self, phase)(model, **options)
+
+    def _names(self, model):
+        """
+        Returns the quoted table, key column and converted key column names 
+        of ``model``, and a natively stored field to convert keys with.
+        """
+        qn = connection.ops.quote_name
+        column = model._meta.pk.column
+        field = UUIDField(version=7, storage='native')
+        return qn(model._meta.db_table), qn(column), \
+            qn("%s_native" % column), field
+
+    @transaction.commit_on_success
+    def add(self, model, **options):
+        table, column, native, field = self._names(model)
+        connection.cursor().execute("ALTER TABLE %s ADD COLUMN %s %s NULL" % 
+                                    (table, native, field.db_type()))
+        transaction.set_dirty()
+        print "Added %s.%s" % (table, native)
+
+    def backfill(self, model, batch_size=1000, pause=0, **options):
+        total = 0
+        while True:
+            converted = self._backfill_batch(model, batch_size)
+            total += converted
+            if converted < batch_size:
+                break
+            if pause:
+                time.sleep(pause)
+        print "Converted %d rows of %s" % (total, model._meta.db_table)
+
+    @commit_on_success_unless_managed
+    def _backfill_batch(self, model, batch_size):
+        table, column, native, field = self._names(model)
+        cursor = connection.cursor()
+        cursor.execute("SELECT %s FROM %s WHERE %s IS NULL LIMIT %d" % 
+                       (column, table, native, batch_size))
+        keys = [row[0] for row in cursor.fetchall()]
+        if keys:
+            cursor.executemany("UPDATE %s SET %s = %%s WHERE %s = %%s" % 
+                (table, native, column), 
+                [(field.get_db_prep_value(key), key) for key in keys])
+            transaction.set_dirty()
+        return len(keys)
+
+    @transaction.commit_on_success
+    def swap(self, model, batch_size=1000, **options):
+        table, column, native, field = self._names(model)
+        cursor = connection.cursor()
+        vendor = db_vendor(connection)
+        if vendor == 'postgresql':
+            cursor.execute("LOCK TABLE %s IN EXCLUSIVE MODE" % table)
+        while self._backfill_batch(model, batch_size) == batch_size:
+            pass
+        if vendor == 'postgresql':
+            cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (table, 
+                connection.ops.quote_name("%s_pkey" % model._meta.db_table)))
+            cursor.execute("ALTER TABLE %s DROP COLUMN %s" % (table, column))
+            cursor.execute("ALTER TABLE %s RENAME COLUMN %s TO %s" % 
+                           (table, native, column))
+            cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (%s)" % (table, column))
+        elif vendor == 'mysql':
+            cursor.execute("ALTER TABLE %s DROP PRIMARY KEY, DROP COLUMN %s, "
+                "CHANGE %s %s %s NOT NULL, ADD PRIMARY KEY (%s)" % (table, 
+                column, native, column, field.db_type(), column))
+        else:
+            self._rebuild(model, cursor)
+        transaction.set_dirty()
+        print "Swapped in the converted keys of %s; set COURSE_UUID_STORAGE " \
+            "to \"native\" now" % table
+
+    def _rebuild(self, model, cursor):
+        """
+        Recreates the table with the new key column for backends like SQLite 
+        which can't drop a primary key column.
+        """
+        qn, opts = connection.ops.quote_name, model._meta
+        table, column, native, field = self._names(model)
+        old = qn("%s__old" % opts.db_table)
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (table, old))
+        # The model still declares text keys until the setting is switched
+        opts.pk.storage = 'native'
+        try:
+            statements, pending = connection.creation.sql_create_model(model, 
+                                                                       no_style())
+        finally:
+            opts.pk.storage = COURSE_UUID_STORAGE
+        for statement in statements:
+            cursor.execute(statement)
+        columns = [qn(f.column) for f in opts.local_fields]
+        sources = [qn(f.column) for f in opts.local_fields]
+        sources[columns.index(column)] = native
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM %s" % (table, 
+            ", ".join(columns), ", ".join(sources), old))
+        cursor.execute("DROP TABLE %s" % old)
+        for statement in connection.creation.sql_indexes_for_model(model, 
+                                                                   no_style()):
+            cursor.execute(statement)
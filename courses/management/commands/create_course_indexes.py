@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+
+from courses.indexes import create_indexes
+
+
+class Command(NoArgsCommand):
+    help = ('Creates the composite indexes of the courses app which are '
+            'missing from the database. New databases get them at syncdb.')
+
+    def handle_noargs(self, **options):
+        if not create_indexes(verbosity=int(options.get('verbosity', 1))):
+            print "All indexes already exist"
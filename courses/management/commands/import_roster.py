@@ -0,0 +1,84 @@
+import csv
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db.models.fields import FieldDoesNotExist
+from django.utils import simplejson
+
+from courses.models import Course
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='Input format, "csv" or "ndjson". Guessed from the file '
+                 'extension if not given.'),
+        make_option('--field', dest='field', default='username',
+            help='The User field identifying each student, e.g. "username", '
+                 '"email" or "id". Defaults to "username".'),
+        make_option('--batch-size', dest='batch_size', type='int', default=500,
+            help='Number of roster rows to enroll per batch. Defaults to 500.'),
+    )
+    help = 'Enrolls the students listed in a CSV or NDJSON roster file in a course.'
+    args = '<course_slug> <roster_file>'
+
+    def handle(self, course_slug=None, path=None, **options):
+        if not (course_slug and path):
+            raise CommandError("Usage: manage.py import_roster %s" % self.args)
+        try:
+            course = Course.objects.get(slug=course_slug)
+        except Course.DoesNotExist:
+            raise CommandError("No course with the slug \"%s\"" % course_slug)
+        format = options.get('format') or path.rsplit('.', 1)[-1].lower()
+        if format == 'json':
+            format = 'ndjson'
+        if format not in ('csv', 'ndjson'):
+            raise CommandError("Unknown roster format \"%s\"" % format)
+        field = options.get('field', 'username')
+        try:
+            to_python = User._meta.get_field(field).to_python
+        except FieldDoesNotExist:
+            raise CommandError("Users have no \"%s\" field" % field)
+        batch_size = options.get('batch_size', 500)
+        
+        totals = {'created': 0, 'reactivated': 0, 'skipped': 0, 'unknown': 0}
+        roster = open(path, 'rU')
+        try:
+            batch = []
+            for key in self._keys(roster, format, field):
+                batch.append(to_python(key))
+                if len(batch) >= batch_size:
+                    self._enroll(course, field, batch, totals)
+                    batch = []
+            if batch:
+                self._enroll(course, field, batch, totals)
+        finally:
+            roster.close()
+        print "Created %(created)d, reactivated %(reactivated)d and skipped " \
+            "%(skipped)d enrollments; %(unknown)d unknown users" % totals
+
+    def _keys(self, roster, format, field):
+        """
+        Yields the value of ``field`` for each row, reading the file lazily so 
+        that it never has to fit in memory.
+        """
+        if format == 'csv':
+            for row in csv.DictReader(roster):
+                if row.get(field):
+                    yield row[field].strip()
+        else:
+            for line in roster:
+                line = line.strip()
+                if line:
+                    value = simplejson.loads(line).get(field)
+                    if value is not None:
+                        yield value
+
+    def _enroll(self, course, field, keys, totals):
+        users = dict(User.objects.filter(**{'%s__in' % field: keys}
+            ).values_list(field, 'pk'))
+        totals['unknown'] += len([key for key in keys if key not in users])
+        counts = course.enroll_many([users[key] for key in keys if key in users])
+        for name, count in counts.items():
+            totals[name] += count
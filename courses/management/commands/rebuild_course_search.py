@@ -0,0 +1,13 @@
+from django.core.management.base import NoArgsCommand, CommandError
+
+from courses import search
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuilds the course and lesson search index from scratch.'
+
+    def handle_noargs(self, **options):
+        if search.get_backend() is None:
+            raise CommandError("Search is disabled; set COURSE_SEARCH_BACKEND "
+                               "to enable it")
+        print "Indexed %d courses and lessons" % search.rebuild()
@@ -0,0 +1,24 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from courses import counters
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', 
+            default=False, help='Report drift without correcting it.'),
+    )
+    help = ('Recomputes the student, lesson and pending request counters of '
+            'every course and corrects those which have drifted.')
+
+    def handle_noargs(self, **options):
+        drift = counters.reconcile(fix=not options['dry_run'])
+        for course_id, name, stored, actual in drift:
+            print "Course %s: %s was %s, counted %s" % (course_id, name, 
+                                                        stored, actual)
+        if options['dry_run']:
+            print "%d counters have drifted" % len(drift)
+        else:
+            print "Corrected %d counters" % len(drift)
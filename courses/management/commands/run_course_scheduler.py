@@ -0,0 +1,38 @@
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from courses import scheduler
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep running, ticking every --interval seconds.'),
+        make_option('--interval', dest='interval', type='float', default=60,
+            help='Seconds between ticks in --loop mode. Defaults to 60.'),
+        make_option('--now', dest='now', default=None,
+            help='Apply the schedule as of this time, given as '
+                 '"YYYY-MM-DD HH:MM:SS", rather than the current time.'),
+    )
+    help = ('Activates and deactivates the courses and lessons whose '
+            'scheduled time has come.')
+
+    def handle(self, **options):
+        now = None
+        if options.get('now'):
+            try:
+                now = datetime.strptime(options['now'], '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                raise CommandError("--now must be given as YYYY-MM-DD HH:MM:SS")
+        verbosity = int(options.get('verbosity', 1))
+        while True:
+            counts = scheduler.tick(now)
+            if verbosity:
+                print ", ".join(["%s %d" % (name.replace('_', ' '), count) 
+                                 for name, count in sorted(counts.items())])
+            if not options.get('loop'):
+                break
+            time.sleep(options.get('interval', 60))
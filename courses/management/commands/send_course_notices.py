@@ -0,0 +1,31 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from courses import notices
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=100,
+            help='Number of notices to claim at a time. Defaults to 100.'),
+        make_option('--loop', dest='loop', action='store_true', default=False,
+            help='Keep running, polling the outbox for new notices.'),
+        make_option('--interval', dest='interval', type='float', default=5,
+            help='Seconds to wait when the outbox is empty in --loop mode. '
+                 'Defaults to 5.'),
+    )
+    help = 'Delivers notices queued in the courses outbox.'
+
+    def handle(self, **options):
+        batch_size = options.get('batch_size', 100)
+        total = 0
+        while True:
+            sent = notices.deliver(batch_size=batch_size)
+            total += sent
+            if not sent:
+                if not options.get('loop'):
+                    break
+                time.sleep(options.get('interval', 5))
+        print "Delivered %d notices" % total
@@ -0,0 +1,267 @@
+import logging
+import re
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+try:
+    from django.db import connections
+except ImportError:
+    # Before Django 1.2 there is just the one database
+    connections = None
+
+from courses import feedback, routers
+
+# Maximum queries per view, by dotted view name
+COURSE_QUERY_BUDGETS = getattr(settings, 'COURSE_QUERY_BUDGETS', {})
+# Whether to 'raise' QueryBudgetExceeded or just 'log' when a budget is broken
+COURSE_QUERY_BUDGET_ACTION = getattr(settings, 'COURSE_QUERY_BUDGET_ACTION', 'log')
+# Times one normalized statement may run in a request before it's an N+1
+COURSE_QUERY_REPEAT_THRESHOLD = getattr(settings, 'COURSE_QUERY_REPEAT_THRESHOLD', 5)
+# Cookie holding the time until which a user's reads stay on the primary
+COURSE_REPLICA_PIN_COOKIE = getattr(settings, 'COURSE_REPLICA_PIN_COOKIE', 'courses_pin')
+
+logger = logging.getLogger('courses.queries')
+
+_stats = {}
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+_NUMBER_RE = re.compile(r'\b\d+(\.\d+)?\b')
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_LIST_RE = re.compile(r'\((\s*\?\s*,)+\s*\?\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+def normalize_sql(sql):
+    """
+    Replaces the literals in ``sql`` with ``?`` and collapses ``IN`` lists,
+    so that statements differing only in their parameters compare equal.
+    """
+    sql = _STRING_RE.sub('?', sql)
+    sql = _NUMBER_RE.sub('?', sql)
+    sql = _LIST_RE.sub('(...)', sql)
+    return _SPACE_RE.sub(' ', sql).strip()
+
+def view_name(view_func):
+    """
+    Returns the dotted name of a view, looking through the wrappers added by
+    decorators such as ``login_required``.
+    """
+    while hasattr(view_func, 'view_func'):
+        view_func = view_func.view_func
+    return "%s.%s" % (view_func.__module__, getattr(view_func, '__name__',
+                                                    view_func.__class__.__name__))
+
+def record(name, queries, budget=None):
+    """
+    Adds the queries one request to the view ``name`` ran, as dictionaries 
+    like the entries of ``connection.queries``, to the aggregated statistics. Returns the
+    normalized statements repeated at least ``COURSE_QUERY_REPEAT_THRESHOLD``
+    times, and enforces ``budget`` if given.
+    """
+    counts = {}
+    total_time = 0.0
+    for query in queries:
+        statement = normalize_sql(query['sql'])
+        counts[statement] = counts.get(statement, 0) + 1
+        total_time += float(query['time'])
+    repeated = [statement for statement, count in counts.items()
+                if count >= COURSE_QUERY_REPEAT_THRESHOLD]
+
+    stats = _stats.setdefault(name, {'requests': 0, 'queries': 0, 'time': 0.0,
+        'max_queries': 0, 'budget_exceeded': 0, 'repeated': {}})
+    stats['requests'] += 1
+    stats['queries'] += len(queries)
+    stats['time'] += total_time
+    stats['max_queries'] = max(stats['max_queries'], len(queries))
+    for statement in repeated:
+        stats['repeated'][statement] = max(stats['repeated'].get(statement, 0),
+                                           counts[statement])
+        logger.warning("%s ran the same statement %d times: %s" %
+                       (name, counts[statement], statement))
+
+    if budget is not None and len(queries) > budget:
+        stats['budget_exceeded'] += 1
+        message = "%s ran %d queries, over its budget of %d" % \
+            (name, len(queries), budget)
+        if COURSE_QUERY_BUDGET_ACTION == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return repeated
+
+def get_stats():
+    """
+    Returns the statistics aggregated in this process by view name, with
+    the mean queries and query time per request added.
+    """
+    result = {}
+    for name, stats in _stats.items():
+        stats = dict(stats)
+        stats['mean_queries'] = float(stats['queries']) / stats['requests']
+        stats['mean_time'] = stats['time'] / stats['requests']
+        result[name] = stats
+    return result
+
+def reset_stats():
+    _stats.clear()
+
+### Query recording ###
+
+_recording = threading.local()
+
+class RecordingCursor(object):
+    """
+    Wraps a database cursor to add the statements it runs, and their times,
+    to ``queries`` as ``connection.queries`` would list them. Unlike Django's
+    debug cursor it works with DEBUG off.
+    """
+    def __init__(self, cursor, db, queries):
+        self.cursor = cursor
+        self.db = db
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.queries.append({
+                'sql': self.db.ops.last_executed_query(self.cursor, sql, params),
+                'time': "%.3f" % (time.time() - start),
+            })
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.queries.append({
+                'sql': '%s times: %s' % (len(param_list), sql),
+                'time': "%.3f" % (time.time() - start),
+            })
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def _install_recorder(db):
+    """
+    Makes the cursors of the connection ``db`` record their queries while 
+    the thread is between ``start_recording`` and ``stop_recording``.
+    """
+    if getattr(db, '_courses_recorder', False):
+        return
+    cursor = db.cursor
+    def recording_cursor():
+        queries = getattr(_recording, 'queries', None)
+        if queries is None:
+            return cursor()
+        return RecordingCursor(cursor(), db, queries)
+    db.cursor = recording_cursor
+    db._courses_recorder = True
+
+def start_recording():
+    """
+    Starts recording the queries this thread runs, on every connection. 
+    Returns a token to pass to ``stop_recording``, as recordings may nest.
+    """
+    if connections is None:
+        _install_recorder(connection)
+    else:
+        for db in connections.all():
+            _install_recorder(db)
+    outer = getattr(_recording, 'queries', None)
+    _recording.queries = []
+    return outer
+
+def stop_recording(outer):
+    """
+    Stops the recording started when ``start_recording`` returned ``outer``,
+    returning the queries run since. They count towards the outer recording
+    as well, if there is one.
+    """
+    queries = _recording.queries
+    if outer is not None:
+        outer.extend(queries)
+    _recording.queries = outer
+    return queries
+
+def query_budget(max_queries):
+    """
+    Decorates a view, or any function, to record the queries each call runs
+    and enforce a budget of ``max_queries`` as ``COURSE_QUERY_BUDGETS`` does.
+    """
+    def decorator(func):
+        name = "%s.%s" % (func.__module__, func.__name__)
+        def _query_budget(*args, **kwargs):
+            outer = start_recording()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                queries = stop_recording(outer)
+            record(name, queries, max_queries)
+            return result
+        _query_budget.__name__ = func.__name__
+        _query_budget.__module__ = func.__module__
+        _query_budget.__doc__ = func.__doc__
+        return _query_budget
+    return decorator
+
+
+class QueryBudgetMiddleware(object):
+    """
+    Records the queries run by each view of the courses app, flags
+    statements repeated within a request as likely N+1 patterns and enforces
+    the budgets in ``COURSE_QUERY_BUDGETS``. The statistics are served as
+    JSON by ``courses.views.query_stats``.
+    """
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = view_name(view_func)
+        if name.startswith('courses.'):
+            request._query_budget = (name, start_recording())
+
+    def process_response(self, request, response):
+        if hasattr(request, '_query_budget'):
+            name, outer = request._query_budget
+            del request._query_budget
+            record(name, stop_recording(outer), COURSE_QUERY_BUDGETS.get(name))
+        return response
+
+
+class ReadYourWritesMiddleware(object):
+    """
+    Keeps the reads of a user who has just changed something on the primary
+    database for ``COURSE_REPLICA_PIN_SECONDS``, so that they see their own
+    change before it reaches the replicas. The deadline is kept in a cookie 
+    rather than the session, which would cost a query of its own.
+    """
+    def process_request(self, request):
+        routers.unpin()
+        try:
+            pinned_until = float(request.COOKIES.get(COURSE_REPLICA_PIN_COOKIE, 0))
+        except ValueError:
+            pinned_until = 0
+        if pinned_until > time.time():
+            routers.pin_to_primary()
+
+    def process_response(self, request, response):
+        if routers.wrote():
+            response.set_cookie(COURSE_REPLICA_PIN_COOKIE, 
+                str(time.time() + routers.COURSE_REPLICA_PIN_SECONDS),
+                max_age=routers.COURSE_REPLICA_PIN_SECONDS)
+        routers.unpin()
+        return response
+
+
+class FeedbackMiddleware(object):
+    """
+    Stores the messages left by ``courses.feedback.add`` with the configured 
+    backend. Must come after ``SessionMiddleware`` when using the session
+    backend.
+    """
+    def process_response(self, request, response):
+        return feedback.process_response(request, response)
@@ -1,11 +1,48 @@
-from django.db import models
+from datetime import datetime
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import signals, F, Max
 from django.contrib.auth.models import User
 from django.utils.translation import ugettext_lazy as _
 
-from courses.utils import UUIDField, slugify
+from courses import cache
+from courses.routers import primary_connection
+from courses.utils import UUIDField, slugify, slugify_many, save_with_retry, \
+    bulk_insert, commit_on_success_unless_managed
 
 # TODO i18n of field names
 
+# How the UUID keys of enrollment requests and teaching invitations are
+# stored: 'char' for 36 characters of text, or 'native' for a uuid or binary
+# column. Existing databases should switch once convert_uuid_storage has 
+# swapped their keys over.
+COURSE_UUID_STORAGE = getattr(settings, 'COURSE_UUID_STORAGE', 'char')
+
+# Most lessons given new positions per UPDATE by ``Course.reorder_lessons``.
+# Each costs three parameters, which keeps well within SQLite's limit of 999.
+LESSON_REORDER_BATCH_SIZE = 300
+
+class CourseRoles(object):
+    """
+    The roles a single user holds in a course, as returned by 
+    ``Course.roles_for``.
+    """
+    def __init__(self, is_teacher=False, is_owner=False, is_student=False):
+        self.is_teacher = is_teacher
+        self.is_owner = is_owner
+        self.is_student = is_student
+        
+    @classmethod
+    def from_bits(cls, bits):
+        return cls(is_teacher=bool(bits & cache.TEACHER), 
+                   is_owner=bool(bits & cache.OWNER), 
+                   is_student=bool(bits & cache.STUDENT))
+        
+    def __repr__(self):
+        return "<CourseRoles teacher=%s owner=%s student=%s>" % \
+            (self.is_teacher, self.is_owner, self.is_student)
+
 class Course(models.Model):
     """
     A Course effectively serves as a collection of lesson objects with shared 
@@ -44,6 +81,19 @@ class Course(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
     activated = models.DateTimeField(null=True)
+    # Times at which ``courses.scheduler.tick`` will activate or deactivate 
+    # the course
+    activate_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    deactivate_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Denormalized counts, maintained by the methods which change them and 
+    # recomputed by ``courses.counters.reconcile``
+    student_count = models.IntegerField(default=0, editable=False)
+    lesson_count = models.IntegerField(default=0, editable=False)
+    pending_request_count = models.IntegerField(default=0, editable=False)
+    
+    RESERVED_SLUGS = ("create", "invitations", "requests", "search", 
+                      "query-stats", "xml", "json")
+    COUNTER_FIELDS = ('student_count', 'lesson_count', 'pending_request_count')
     
     class Meta:
         verbose_name = _('course')
@@ -54,10 +104,47 @@ class Course(models.Model):
         return self.title
         
     def save(self, force_insert=False, force_update=False):
-        self.slug = slugify(self.title, 
-                            invalid=("create", "invitations", "requests"), 
-                            instance=self)
-        super(Course, self).save(force_insert, force_update)
+        if not getattr(self, '_slug_allocated', False):
+            self.slug = slugify(self.title, 
+                                invalid=self.RESERVED_SLUGS, 
+                                instance=self)
+        self._slug_allocated = False
+        if self.pk is None or force_insert or \
+                not Course.objects.filter(pk=self.pk).count():
+            super(Course, self).save(force_insert, force_update)
+        else:
+            self._save_without_counters()
+            
+    def _save_without_counters(self):
+        """
+        Updates every column of an existing course but the counters, which 
+        may have moved on since this instance was loaded, sending the same
+        signals as ``save``.
+        """
+        signals.pre_save.send(sender=Course, instance=self, raw=False)
+        values = {}
+        for field in self._meta.local_fields:
+            if not field.primary_key and field.name not in self.COUNTER_FIELDS:
+                values[field.name] = field.pre_save(self, False)
+        Course.objects.filter(pk=self.pk).update(**values)
+        signals.post_save.send(sender=Course, instance=self, created=False)
+        
+    def set_activated(self, activated):
+        """
+        Activates the course as of ``activated``, or deactivates it if that is
+        ``None``, updating just the columns concerned.
+        """
+        self.activated, self.modified = activated, datetime.now()
+        Course.objects.filter(pk=self.pk).update(activated=self.activated, 
+                                                 modified=self.modified)
+        cache.bump_generation(self.pk)
+        
+    @classmethod
+    def allocate_slugs(cls, courses):
+        """
+        Assigns slugs to many unsaved courses at once, e.g. for bulk imports.
+        """
+        return slugify_many(courses, invalid=cls.RESERVED_SLUGS)
         
     def get_absolute_url(self):
         return "/courses/%s/" % self.slug
@@ -70,21 +157,366 @@ class Course(models.Model):
         
     def owners(self):
         return self.teachers.filter(teachership__is_owner=True)
+        
+    def roles_for(self, user):
+        """
+        Returns a ``CourseRoles`` describing whether ``user`` is an active 
+        teacher, an owner and/or an active student of this course.
+        
+        Membership is resolved with single-row lookups on the ``Teachership``
+        and ``Enrollment`` tables rather than by loading the full teacher or 
+        student lists, and the result is memoized on this instance so that 
+        repeated checks within a request cost nothing.
+        """
+        if not getattr(user, 'is_authenticated', None) or \
+                not user.is_authenticated():
+            return CourseRoles()
+        memo = self.__dict__.setdefault('_roles_cache', {})
+        if user.pk not in memo:
+            bits, version = cache.get_roles(self.pk, user.pk)
+            if bits is None:
+                teacher = list(Teachership.objects.filter(course=self, 
+                    teacher=user, is_active=True
+                ).values_list('is_owner', flat=True)[:1])
+                student = list(Enrollment.objects.filter(course=self, 
+                    student=user, is_active=True
+                ).values_list('pk', flat=True)[:1])
+                bits = 0
+                if teacher:
+                    bits |= cache.TEACHER
+                    if teacher[0]:
+                        bits |= cache.OWNER
+                if student:
+                    bits |= cache.STUDENT
+                cache.set_roles(self.pk, user.pk, bits, version)
+            memo[user.pk] = CourseRoles.from_bits(bits)
+        return memo[user.pk]
+        
+    def _forget_roles(self, user):
+        memo = self.__dict__.get('_roles_cache')
+        if memo:
+            memo.pop(user.pk, None)
+        cache.invalidate_roles(self.pk, user.pk)
+    
+    @commit_on_success_unless_managed
+    def reorder_lessons(self, positions):
+        """
+        Moves the lessons of this course to new positions, where 
+        ``positions[i]`` is the new position of the lesson currently i-th in
+        order. ``positions`` must be a permutation of 1 to the number of 
+        lessons, otherwise ``ValueError`` is raised and nothing changes.
+        
+        This costs one SELECT and an UPDATE, plus an UPDATE per 
+        ``LESSON_REORDER_BATCH_SIZE`` lessons: the lessons are first moved 
+        clear of their current positions so that the ``unique_together`` 
+        constraint can't be tripped half way through, then given their new 
+        positions a batch at a time. The course row is locked first, as 
+        ``reserve_lesson_positions`` does, so that no lesson can be added in 
+        between.
+        """
+        self.touch()
+        lessons = list(Lesson.objects.filter(course=self).values_list('pk', 
+                                                                   'position'))
+        positions = [int(position) for position in positions]
+        if sorted(positions) != range(1, len(lessons) + 1):
+            raise ValueError("Lesson positions must be a permutation of 1 to %d" 
+                             % len(lessons))
+        if not lessons:
+            return
+        offset = max([position for pk, position in lessons])
+        Lesson.objects.filter(course=self).update(position=F('position') + offset)
+        connection = primary_connection()
+        opts, qn = Lesson._meta, connection.ops.quote_name
+        moves = [(pk, new) for (pk, old), new in zip(lessons, positions)]
+        for start in range(0, len(moves), LESSON_REORDER_BATCH_SIZE):
+            batch = moves[start:start + LESSON_REORDER_BATCH_SIZE]
+            params = []
+            for pk, new in batch:
+                params.extend([pk, new])
+            # The new positions are all below the offset ones, so batches 
+            # can't collide with the lessons still waiting for theirs
+            connection.cursor().execute(
+                "UPDATE %(table)s SET %(position)s = CASE %(cases)s "
+                "ELSE %(position)s END WHERE %(course)s = %%s AND "
+                "%(pk)s IN (%(pks)s)" % {
+                    'table': qn(opts.db_table),
+                    'position': qn(opts.get_field('position').column),
+                    'course': qn(opts.get_field('course').column),
+                    'pk': qn(opts.pk.column),
+                    'cases': " ".join(["WHEN %s = %%s THEN %%s" % 
+                                       qn(opts.pk.column)] * len(batch)),
+                    'pks': ", ".join(["%s"] * len(batch)),
+                }, params + [self.pk] + [pk for pk, new in batch])
+        transaction.set_dirty()
+        cache.bump_generation(self.pk)
+            
+    @commit_on_success_unless_managed
+    def move_lesson(self, lesson, position):
+        """
+        Moves ``lesson`` to ``position``, shifting the lessons in between up or
+        down by one. Only the rows in the affected range are touched, in two 
+        UPDATEs which keep clear of the ``unique_together`` constraint. The 
+        course row is locked first and the lesson's position read again 
+        under the lock.
+        """
+        position = int(position)
+        self.touch()
+        count = Lesson.objects.filter(course=self).count()
+        if lesson.course_id != self.pk or not 1 <= position <= count:
+            raise ValueError("Lesson position must be between 1 and %d" % count)
+        current = list(Lesson.objects.filter(pk=lesson.pk, course=self
+            ).values_list('position', flat=True))
+        if not current:
+            raise ValueError("The lesson has been removed from the course")
+        current = lesson.position = current[0]
+        if position == current:
+            return
+        if position > current:
+            low, high, shift = current, position, -1
+        else:
+            low, high, shift = position, current, 1
+        offset = Lesson.objects.filter(course=self).aggregate(
+            Max('position'))['position__max']
+        Lesson.objects.filter(course=self, position__gte=low, 
+            position__lte=high).update(position=F('position') + offset)
+        connection = primary_connection()
+        opts, qn = Lesson._meta, connection.ops.quote_name
+        column = qn(opts.get_field('position').column)
+        connection.cursor().execute(
+            "UPDATE %(table)s SET %(position)s = CASE WHEN %(position)s = %%s "
+            "THEN %%s ELSE %(position)s - %%s END "
+            "WHERE %(course)s = %%s AND %(position)s > %%s" % {
+                'table': qn(opts.db_table),
+                'position': column,
+                'course': qn(opts.get_field('course').column),
+            }, [current + offset, position, offset - shift, self.pk, offset])
+        transaction.set_dirty()
+        lesson.position = position
+        cache.bump_generation(self.pk)
+    
+    @classmethod
+    def adjust_counters(cls, course_id, **deltas):
+        """
+        Adds ``deltas``, keyed by counter field name, to the counters of the 
+        course with one atomic UPDATE.
+        """
+        deltas = dict([(name, delta) for name, delta in deltas.items() if delta])
+        if deltas:
+            cls.objects.filter(pk=course_id).update(**dict([
+                (name, F(name) + delta) for name, delta in deltas.items()]))
+        return deltas
+        
+    def _adjust_counters(self, **deltas):
+        # Keep this instance's counts current for whoever reads them next
+        for name, delta in Course.adjust_counters(self.pk, **deltas).items():
+            setattr(self, name, getattr(self, name) + delta)
+    
+    def _lock(self):
+        # A no-op UPDATE, which holds the row lock until the transaction ends
+        Course.objects.filter(pk=self.pk).update(
+            pending_request_count=F('pending_request_count'))
+        
+    def touch(self):
+        """
+        Updates ``modified`` without saving the rest of the course, for changes
+        to its lessons which alter what course pages show.
+        """
+        self.modified = datetime.now()
+        Course.objects.filter(pk=self.pk).update(modified=self.modified)
+        cache.bump_generation(self.pk)
+        
+    def outline(self):
+        """
+        Returns the list of this course's lessons in order, from the fragment 
+        cache where possible.
+        """
+        lessons, generation = cache.get_fragment(self.pk, 'outline')
+        if lessons is None:
+            lessons = list(self.lesson_set.all())
+            cache.set_fragment(self.pk, 'outline', lessons, generation)
+        for lesson in lessons:
+            lesson.course = self
+        return lessons
+        
+    def get_lesson(self, slug):
+        """
+        Returns the lesson of this course with the given slug, from the 
+        fragment cache where possible, raising ``Lesson.DoesNotExist`` if 
+        there is none.
+        """
+        name = 'lesson.%s' % slug
+        lesson, generation = cache.get_fragment(self.pk, name)
+        if lesson is None:
+            lesson = Lesson.objects.get(course=self, slug=slug)
+            cache.set_fragment(self.pk, name, lesson, generation)
+        lesson.course = self
+        return lesson
+        
+    def reserve_lesson_positions(self, count=1):
+        """
+        Returns the first of ``count`` contiguous free lesson positions at the
+        end of this course. 
+        
+        The course row is locked by ``touch``ing it, so 
+        concurrent reservations wait for the transaction holding this one to 
+        end. Call this inside the transaction that saves the lessons.
+        """
+        self.touch()
+        top = Lesson.objects.filter(course=self).aggregate(
+            Max('position'))['position__max']
+        return (top or 0) + 1
+        
+    @commit_on_success_unless_managed
+    def add_lessons(self, lessons):
+        """
+        Appends several unsaved lessons to the end of this course, in order, 
+        reserving a single block of positions for them. A lesson whose 
+        preallocated slug is taken by a concurrent insert gets a fresh one.
+        """
+        lessons = list(lessons)
+        for lesson in lessons:
+            lesson.course = self
+        Lesson.allocate_slugs(lessons)
+        position = self.reserve_lesson_positions(len(lessons))
+        for offset, lesson in enumerate(lessons):
+            lesson.position = position + offset
+            save_with_retry(lesson)
+        return lessons
     
     # TODO the Course class probably isn't the most appropriate place 
     # for the following 4 methods
     def enroll(self, user):
         e, created = Enrollment.objects.get_or_create(course=self, student=user)
-        if not created:
+        if created:
+            self._adjust_counters(student_count=1)
+        elif not e.is_active:
             e.is_active = True
             e.save()
+            self._adjust_counters(student_count=1)
+        self._forget_roles(user)
         return created
     
+    @commit_on_success_unless_managed
+    def enroll_many(self, users, batch_size=500):
+        """
+        Enrolls many users, given as ``User`` instances or primary keys, in 
+        batches of ``batch_size``. Each batch costs one SELECT for existing 
+        enrollments, one UPDATE reactivating inactive ones and one multi-row 
+        INSERT for the rest.
+        
+        Returns a dictionary counting the enrollments ``created``, the 
+        inactive ones ``reactivated`` and the users ``skipped`` as already 
+        active or repeated.
+        """
+        counts = {'created': 0, 'reactivated': 0, 'skipped': 0}
+        seen, batch = set(), []
+        for user in users:
+            user_id = getattr(user, 'pk', user)
+            if user_id in seen:
+                counts['skipped'] += 1
+                continue
+            seen.add(user_id)
+            batch.append(user_id)
+            if len(batch) >= batch_size:
+                self._enroll_batch(batch, counts)
+                batch = []
+        if batch:
+            self._enroll_batch(batch, counts)
+        self._adjust_counters(student_count=counts['created'] + 
+                                            counts['reactivated'])
+        self.__dict__.pop('_roles_cache', None)
+        return counts
+        
+    def _enroll_batch(self, user_ids, counts):
+        existing = dict(Enrollment.objects.filter(course=self, 
+            student__in=user_ids).values_list('student', 'is_active'))
+        inactive = [pk for pk, is_active in existing.items() if not is_active]
+        now = datetime.now()
+        if inactive:
+            Enrollment.objects.filter(course=self, student__in=inactive
+                ).update(is_active=True, modified=now)
+        new = [pk for pk in user_ids if pk not in existing]
+        bulk_insert(Enrollment, ('student', 'course', 'created', 'modified', 
+                                 'is_active'), 
+                    [(pk, self.pk, now, now, True) for pk in new])
+        for pk in inactive + new:
+            cache.invalidate_roles(self.pk, pk)
+        counts['created'] += len(new)
+        counts['reactivated'] += len(inactive)
+        counts['skipped'] += len(existing) - len(inactive)
+    
+    @commit_on_success_unless_managed
+    def respond_to_requests(self, requests, accept):
+        """
+        Accepts, or declines, several pending ``EnrollmentRequest`` instances 
+        of this course at once: their statuses change with one UPDATE and 
+        accepted requestors are enrolled with ``enroll_many``. The caller is 
+        responsible for checking that the user responding teaches the course.
+        
+        The course row is locked first, so that teachers answering the same
+        requests at once take turns, and only the requests still pending 
+        under the lock are answered and returned.
+        """
+        requests = [er for er in requests 
+                    if er.course_id == self.pk and er.status == 'R']
+        if not requests:
+            return requests
+        self._lock()
+        uuid_field = EnrollmentRequest._meta.pk
+        pending = set([uuid_field.to_python(value) for value in 
+            EnrollmentRequest.objects.filter(course=self, status='R', 
+                uuid__in=[er.uuid for er in requests]
+            ).values_list('uuid', flat=True)])
+        requests = [er for er in requests if er.uuid in pending]
+        if not requests:
+            return requests
+        status, now = accept and 'A' or 'D', datetime.now()
+        EnrollmentRequest.objects.filter(course=self, status='R', 
+            uuid__in=[er.uuid for er in requests]
+        ).update(status=status, modified=now)
+        self._adjust_counters(pending_request_count=-len(requests))
+        for er in requests:
+            er.status, er.modified, er._saved_status = status, now, status
+        if accept:
+            self.enroll_many([er.requestor_id for er in requests])
+        return requests
+    
+    @commit_on_success_unless_managed
+    def invite_teachers(self, invitor, invitees):
+        """
+        Invites several ``User`` instances to teach this course on behalf of 
+        ``invitor`` with one multi-row INSERT. Users who already teach the course, or who 
+        ``invitor`` has already invited, are skipped.
+        
+        Returns the new ``TeachingInvitation`` instances.
+        """
+        invitees = dict([(invitee.pk, invitee) for invitee in invitees])
+        skip = set(Teachership.objects.filter(course=self, is_active=True, 
+            teacher__in=invitees.keys()).values_list('teacher', flat=True))
+        skip.update(TeachingInvitation.objects.filter(course=self, 
+            invitor=invitor, invitee__in=invitees.keys()
+        ).values_list('invitee', flat=True))
+        uuid_field = TeachingInvitation._meta.pk
+        now = datetime.now()
+        invitations = [TeachingInvitation(uuid=unicode(uuid_field.create_uuid()), 
+                                          invitor=invitor, invitee=invitee, 
+                                          course=self, status="I", 
+                                          created=now, modified=now) 
+                       for pk, invitee in invitees.items() if pk not in skip]
+        bulk_insert(TeachingInvitation, ('uuid', 'invitor', 'invitee', 'course', 
+                                         'created', 'modified', 'status'), 
+                    [(i.uuid, invitor.pk, i.invitee_id, self.pk, now, now, "I") 
+                     for i in invitations])
+        return invitations
+    
     def unenroll(self, user):
         try:
             e = Enrollment.objects.get(course=self, student=user)
-            e.is_active = False
-            e.save()
+            if e.is_active:
+                e.is_active = False
+                e.save()
+                self._adjust_counters(student_count=-1)
+            self._forget_roles(user)
             return True
         except Enrollment.DoesNotExist:
             return False
@@ -94,13 +526,15 @@ class Course(models.Model):
         if not created:
             t.is_active = True
             t.save()
+        self._forget_roles(user)
         return created
         
     def unappoint_teacher(self, user):
         try:
-            t = Tearchership.objects.get(course=self, teacher=user)
+            t = Teachership.objects.get(course=self, teacher=user)
             t.is_active = False
             t.save()
+            self._forget_roles(user)
             return True
         except Teachership.DoesNotExist:
             return False
@@ -141,7 +575,7 @@ class EnrollmentRequest(models.Model):
         ('D', 'Declined'),
     )
         
-    uuid = UUIDField(primary_key=True, max_length=36)
+    uuid = UUIDField(primary_key=True, version=7, storage=COURSE_UUID_STORAGE)
     requestor = models.ForeignKey(User, related_name='requestor')
     course = models.ForeignKey(Course)
     created = models.DateTimeField(auto_now_add=True)
@@ -151,10 +585,27 @@ class EnrollmentRequest(models.Model):
     class Meta:
         verbose_name = _('enrollment request')
         verbose_name_plural = _('enrollment requests')
+        
+    def __init__(self, *args, **kwargs):
+        super(EnrollmentRequest, self).__init__(*args, **kwargs)
+        # The status as last saved, so that save can tell whether the request
+        # joined or left the course's pending count
+        self._saved_status = self.uuid and self.status or None
             
     def __unicode__(self):
         return "%(requestor)s requested to join the \"%(course)s\" course" % \
             {'requestor': self.requestor, 'course': self.course}
+    
+    @commit_on_success_unless_managed
+    def save(self, force_insert=False, force_update=False):
+        super(EnrollmentRequest, self).save(force_insert, force_update)
+        delta = int(self.status == 'R') - int(self._saved_status == 'R')
+        course = getattr(self, '_course_cache', None)
+        if course is not None:
+            course._adjust_counters(pending_request_count=delta)
+        else:
+            Course.adjust_counters(self.course_id, pending_request_count=delta)
+        self._saved_status = self.status
 
 
 class Teachership(models.Model):
@@ -188,7 +639,7 @@ class TeachingInvitation(models.Model):
         ('D', 'Declined'),
     )
         
-    uuid = UUIDField(primary_key=True, max_length=36)
+    uuid = UUIDField(primary_key=True, version=7, storage=COURSE_UUID_STORAGE)
     invitor = models.ForeignKey(User, related_name="invitor")
     invitee = models.ForeignKey(User, related_name="invitee")
     course = models.ForeignKey(Course)
@@ -221,7 +672,11 @@ class Lesson(models.Model):
     course = models.ForeignKey(Course)
     created = models.DateTimeField(auto_now_add=True)
     modified = models.DateTimeField(auto_now=True)
-    activated = models.DateTimeField(null=True, auto_now_add=True)
+    activated = models.DateTimeField(null=True)
+    activate_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    deactivate_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    RESERVED_SLUGS = ('actions', 'teachers', 'students')
     
     class Meta:
         verbose_name = _('lesson')
@@ -232,18 +687,120 @@ class Lesson(models.Model):
     def __unicode__(self):
         return self.title
         
+    @commit_on_success_unless_managed
     def save(self, force_insert=False, force_update=False):
-        self.slug = slugify(self.title, 
-                            instance=self, 
-                            invalid=('actions', 'teachers'), 
-                            extra_lookup={'course': self.course})
+        # Slugs are unique across all lessons, not just those of one course
+        if not getattr(self, '_slug_allocated', False):
+            self.slug = slugify(self.title, 
+                                instance=self, 
+                                invalid=self.RESERVED_SLUGS)
+        self._slug_allocated = False
         if not self.position:
-            self.position = len(Lesson.objects.filter(course=self.course)) + 1
+            self.position = self.course.reserve_lesson_positions()
+        adding = not self.pk
+        if adding and self.activated is None:
+            # New lessons are active at once unless scheduled for later
+            now = datetime.now()
+            if not self.activate_at or self.activate_at <= now:
+                self.activated = now
         super(Lesson, self).save(force_insert, force_update)
+        if adding:
+            self.course._adjust_counters(lesson_count=1)
+        
+    @classmethod
+    def allocate_slugs(cls, lessons):
+        """
+        Assigns slugs to many unsaved lessons at once, e.g. for bulk imports.
+        """
+        return slugify_many(lessons, invalid=cls.RESERVED_SLUGS)
         
     def get_absolute_url(self):
         return "/courses/%(cslug)s/%(lslug)s/" % \
             {'cslug': self.course.slug, 'lslug': self.slug}
+
+
+class QueuedNotice(models.Model):
+    """
+    A notice waiting in the outbox to be delivered to a single recipient by
+    ``courses.notices.deliver``.
+    
+    Notices are recorded in the same transaction as the change they describe
+    and delivered later in batches, so requests never wait on notification
+    delivery.
+    """
+    recipient = models.ForeignKey(User)
+    label = models.CharField(max_length=40)
+    pickled_context = models.TextField()
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    lease = models.CharField(max_length=36, blank=True, db_index=True)
+    sent = models.DateTimeField(null=True)
+    last_error = models.TextField(blank=True)
+    
+    class Meta:
+        verbose_name = _('queued notice')
+        verbose_name_plural = _('queued notices')
+        ordering = ['next_attempt']
         
+    def __unicode__(self):
+        return "\"%(label)s\" notice for %(recipient)s" % \
+            {'label': self.label, 'recipient': self.recipient}
+
+
+### Role cache invalidation ###
+
+def _invalidate_enrollment_roles(sender, instance, **kwargs):
+    cache.invalidate_roles(instance.course_id, instance.student_id)
+
+def _invalidate_teachership_roles(sender, instance, **kwargs):
+    cache.invalidate_roles(instance.course_id, instance.teacher_id)
+
+signals.post_save.connect(_invalidate_enrollment_roles, sender=Enrollment)
+signals.post_delete.connect(_invalidate_enrollment_roles, sender=Enrollment)
+signals.post_save.connect(_invalidate_teachership_roles, sender=Teachership)
+signals.post_delete.connect(_invalidate_teachership_roles, sender=Teachership)
+
+
+### Fragment cache invalidation ###
+
+def _bump_course_generation(sender, instance, **kwargs):
+    cache.bump_generation(instance.pk)
+
+def _bump_lesson_course_generation(sender, instance, **kwargs):
+    cache.bump_generation(instance.course_id)
+
+signals.post_save.connect(_bump_course_generation, sender=Course)
+signals.post_delete.connect(_bump_course_generation, sender=Course)
+signals.post_save.connect(_bump_lesson_course_generation, sender=Lesson)
+signals.post_delete.connect(_bump_lesson_course_generation, sender=Lesson)
+
+### Counter maintenance ###
+
+def _uncount_lesson(sender, instance, **kwargs):
+    Course.adjust_counters(instance.course_id, lesson_count=-1)
+
+def _uncount_enrollment_request(sender, instance, **kwargs):
+    if instance._saved_status == 'R':
+        Course.adjust_counters(instance.course_id, pending_request_count=-1)
+
+signals.post_delete.connect(_uncount_lesson, sender=Lesson)
+signals.post_delete.connect(_uncount_enrollment_request, sender=EnrollmentRequest)
+
+### Search index maintenance ###
+
+def _index_for_search(sender, instance, **kwargs):
+    from courses.search import get_backend
+    backend = get_backend()
+    if backend:
+        backend.index(instance)
 
+def _remove_from_search(sender, instance, **kwargs):
+    from courses.search import get_backend
+    backend = get_backend()
+    if backend:
+        backend.remove(instance)
 
+for model in (Course, Lesson):
+    signals.post_save.connect(_index_for_search, sender=model)
+    signals.post_delete.connect(_remove_from_search, sender=model)
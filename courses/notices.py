@@ -0,0 +1,93 @@
+import base64
+import cPickle as pickle
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.db.models import get_app
+
+from courses.models import QueuedNotice
+from courses.utils import bulk_insert
+
+try:
+    import uuid
+except ImportError:
+    from django.utils import uuid
+
+try:
+    notification = get_app("notification")
+except ImproperlyConfigured:
+    notification = None
+
+# Deliver notices inside the request rather than through the outbox, 
+# e.g. for tests
+COURSE_NOTICES_SYNC = getattr(settings, 'COURSE_NOTICES_SYNC', False)
+COURSE_NOTICES_MAX_ATTEMPTS = getattr(settings, 'COURSE_NOTICES_MAX_ATTEMPTS', 6)
+# Seconds a worker may hold claimed notices before others may retry them
+COURSE_NOTICES_LEASE = getattr(settings, 'COURSE_NOTICES_LEASE', 300)
+
+def send(users, label, extra_context=None):
+    send_many([(users, label, extra_context or {})])
+
+def send_many(notices):
+    """
+    Records a batch of notices, each a ``(users, label, extra_context)`` 
+    tuple, in the outbox with a single INSERT. Call this inside the 
+    transaction making the change the notices describe, so that they are 
+    only delivered if it commits.
+    """
+    if not notification:
+        return
+    if COURSE_NOTICES_SYNC:
+        for users, label, extra_context in notices:
+            notification.send(users, label, extra_context)
+        return
+    now = datetime.now()
+    rows = []
+    for users, label, extra_context in notices:
+        context = base64.b64encode(pickle.dumps(extra_context, 
+                                                pickle.HIGHEST_PROTOCOL))
+        for user in users:
+            rows.append((user.pk, label, context, now, now, 0, "", "", None))
+    bulk_insert(QueuedNotice, ('recipient', 'label', 'pickled_context', 
+                               'created', 'next_attempt', 'attempts', 'lease', 
+                               'last_error', 'sent'), rows)
+
+def deliver(batch_size=100, now=None):
+    """
+    Claims up to ``batch_size`` due notices from the outbox and delivers 
+    them, returning the number delivered. Safe to run from several workers
+    at once, as each claims its batch with a lease before delivering it.
+    
+    A notice which fails is retried with exponential backoff, up to 
+    ``COURSE_NOTICES_MAX_ATTEMPTS`` times.
+    """
+    if not notification:
+        return 0
+    now = now or datetime.now()
+    due = QueuedNotice.objects.filter(sent__isnull=True, next_attempt__lte=now, 
+        attempts__lt=COURSE_NOTICES_MAX_ATTEMPTS)
+    candidates = list(due.values_list('pk', flat=True)[:batch_size])
+    if not candidates:
+        return 0
+    lease = unicode(uuid.uuid4())
+    due.filter(pk__in=candidates).update(lease=lease, 
+        next_attempt=now + timedelta(seconds=COURSE_NOTICES_LEASE))
+    claimed = list(QueuedNotice.objects.filter(lease=lease))
+    users = User.objects.in_bulk([notice.recipient_id for notice in claimed])
+    delivered = []
+    for notice in claimed:
+        try:
+            notification.send([users[notice.recipient_id]], notice.label, 
+                pickle.loads(base64.b64decode(notice.pickled_context)))
+        except Exception, e:
+            notice.attempts += 1
+            notice.next_attempt = now + timedelta(minutes=2 ** notice.attempts)
+            notice.last_error = repr(e)
+            notice.lease = ""
+            notice.save()
+        else:
+            delivered.append(notice.pk)
+    QueuedNotice.objects.filter(pk__in=delivered).update(sent=now, lease="")
+    return len(delivered)
@@ -0,0 +1,80 @@
+from datetime import datetime
+
+from django.db import connection
+
+from courses.models import Course, Enrollment, EnrollmentRequest, Lesson, \
+    Teachership
+from courses.utils import db_vendor, keyset_after
+
+def key_queries(course, user):
+    """
+    Returns the hot queries of the app as ``(name, queryset)`` pairs, for the
+    given course and user, built as the views build them.
+    """
+    return [
+        ('active students', Enrollment.objects.filter(course=course, 
+            is_active=True).values_list('student', flat=True)),
+        ('active teachers', Teachership.objects.filter(course=course, 
+            is_active=True).values_list('teacher', flat=True)),
+        ('courses taught', Teachership.objects.filter(teacher=user, 
+            is_active=True).values_list('course', flat=True)),
+        ('student role', Enrollment.objects.filter(course=course, student=user, 
+            is_active=True).values_list('pk', flat=True)[:1]),
+        ('pending requests', EnrollmentRequest.objects.filter(course=course, 
+            status='R').order_by('created')),
+        ('request inbox', keyset_after(EnrollmentRequest.objects.filter(
+            course__teachership__teacher=user, 
+            course__teachership__is_active=True, 
+            status='R'), 'created')[:51]),
+        ('active lessons', Lesson.objects.filter(course=course, 
+            activated__isnull=False)),
+        ('catalog page', keyset_after(Course.objects.all(), 'activated', 
+            datetime(2000, 1, 1), 0)[:21]),
+    ]
+
+def _sql(queryset):
+    query = queryset.query
+    if hasattr(query, 'get_compiler'):
+        return query.get_compiler(using=queryset.db).as_sql()
+    return query.as_sql()
+
+def explain(queryset):
+    """
+    Returns the lines of the database's query plan for ``queryset``.
+    """
+    sql, params = _sql(queryset)
+    cursor = connection.cursor()
+    if db_vendor(connection) == 'sqlite':
+        cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[-1] for row in cursor.fetchall()]
+    cursor.execute("EXPLAIN " + sql, params)
+    return [" ".join([str(column) for column in row]) for row in cursor.fetchall()]
+
+def full_scans(plan):
+    """
+    Returns the lines of ``plan`` which read a whole table rather than 
+    searching an index.
+    """
+    vendor = db_vendor(connection)
+    scans = []
+    for line in plan:
+        if vendor == 'sqlite':
+            # Scanning an index still visits every row, only in index order
+            if line.startswith('SCAN'):
+                scans.append(line)
+        elif vendor == 'postgresql':
+            if 'Seq Scan' in line:
+                scans.append(line)
+        elif 'ALL' in line.split():
+            scans.append(line)
+    return scans
+
+def check(course, user):
+    """
+    Returns ``(name, plan, full_scans)`` for each of the key queries.
+    """
+    results = []
+    for name, queryset in key_queries(course, user):
+        plan = explain(queryset)
+        results.append((name, plan, full_scans(plan)))
+    return results
@@ -0,0 +1,112 @@
+import random
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    from django.db import connections
+except ImportError:
+    # Before Django 1.2 there is just the one database
+    from django.db import connection
+    connections = None
+
+# The database aliases of the read replicas of COURSE_PRIMARY_DATABASE. Reads
+# of the courses models are spread over them, and stay on the primary if
+# there are none.
+COURSE_PRIMARY_DATABASE = getattr(settings, 'COURSE_PRIMARY_DATABASE', 'default')
+COURSE_DATABASE_REPLICAS = getattr(settings, 'COURSE_DATABASE_REPLICAS', ())
+# Seconds for which a user's reads stay on the primary after they change 
+# something, which should exceed the replicas' usual lag
+COURSE_REPLICA_PIN_SECONDS = getattr(settings, 'COURSE_REPLICA_PIN_SECONDS', 5)
+
+if COURSE_DATABASE_REPLICAS and connections is None:
+    raise ImproperlyConfigured("COURSE_DATABASE_REPLICAS needs database "
+                               "routers, which arrived in Django 1.2")
+
+_state = threading.local()
+
+def pin_to_primary():
+    """
+    Sends the reads of the current thread to the primary until ``unpin`` is
+    called, e.g. for the rest of a request which has written.
+    """
+    _state.pinned = True
+
+def unpin():
+    _state.pinned = False
+    _state.wrote = False
+
+def is_pinned():
+    return getattr(_state, 'pinned', False)
+
+def wrote():
+    """
+    Returns whether the current thread has been routed a write since it was
+    last unpinned.
+    """
+    return getattr(_state, 'wrote', False)
+
+def primary_connection():
+    """
+    Returns the connection to the primary database for writing raw SQL to,
+    and treats the thread as having written, as the router does for writes 
+    through the ORM.
+    """
+    _state.wrote = True
+    pin_to_primary()
+    if connections is None:
+        return connection
+    return connections[COURSE_PRIMARY_DATABASE]
+
+
+class ReplicaRouter(object):
+    """
+    Routes reads of the courses models to a randomly chosen replica and 
+    writes to the primary. Once a thread has been routed a write, its reads 
+    go to the primary as well, and ``ReadYourWritesMiddleware`` keeps the 
+    user's later requests there for ``COURSE_REPLICA_PIN_SECONDS``.
+    
+    To try it locally with two SQLite databases, use settings such as::
+    
+        DATABASES = {
+            'default': {'ENGINE': 'django.db.backends.sqlite3', 
+                        'NAME': 'primary.db', 'TEST_NAME': 'test.db'},
+            'replica': {'ENGINE': 'django.db.backends.sqlite3', 
+                        'NAME': 'replica.db', 'TEST_MIRROR': 'default'},
+        }
+        DATABASE_ROUTERS = ['courses.routers.ReplicaRouter']
+        COURSE_DATABASE_REPLICAS = ('replica',)
+    
+    and run ``manage.py test courses``: ``ReplicaDatabaseTest`` then reads 
+    and writes through both databases, which share the test database file. 
+    An in-memory test database can't be shared, hence ``TEST_NAME``. The 
+    mirror needs Django 1.3, as 1.2's test runner fails on it. Raw SQL 
+    writes must use ``primary_connection``. Database routers arrived in 
+    Django 1.2, and setting ``COURSE_DATABASE_REPLICAS`` on earlier versions
+    raises ``ImproperlyConfigured``.
+    """
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label != 'courses':
+            return None
+        if is_pinned() or not COURSE_DATABASE_REPLICAS:
+            return COURSE_PRIMARY_DATABASE
+        return random.choice(COURSE_DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'courses':
+            return None
+        _state.wrote = True
+        pin_to_primary()
+        return COURSE_PRIMARY_DATABASE
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = (COURSE_PRIMARY_DATABASE,) + tuple(COURSE_DATABASE_REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_syncdb(self, db, model):
+        if db in COURSE_DATABASE_REPLICAS:
+            return False
+        return None
@@ -0,0 +1,101 @@
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from courses import cache, notices
+from courses.models import Course, Enrollment, Lesson, Teachership
+
+def _flip(model, field, now, activate):
+    """
+    Activates or deactivates the rows of ``model`` whose ``field`` time has
+    come with one UPDATE, clearing the schedule, and returns the affected
+    rows as ``(pk, course_id)`` pairs.
+    """
+    due = model.objects.filter(**{'%s__lte' % field: now}).order_by()
+    if model is Course:
+        rows = [(pk, pk) for pk in due.values_list('pk', flat=True)]
+    else:
+        rows = list(due.values_list('pk', 'course'))
+    if rows:
+        model.objects.filter(pk__in=[pk for pk, course_id in rows]).update(**{
+            'activated': activate and now or None, 
+            field: None, 
+            'modified': now})
+    return rows
+
+def _members(course_ids, with_teachers):
+    """
+    Returns the active students, and teachers too if ``with_teachers``, of 
+    each of the courses, by course id, with one query per role.
+    """
+    members = dict([(course_id, []) for course_id in course_ids])
+    roles = [(Enrollment, 'student')]
+    if with_teachers:
+        roles.append((Teachership, 'teacher'))
+    for model, role in roles:
+        rows = list(model.objects.filter(course__in=course_ids, 
+            is_active=True).values_list('course', role))
+        users = User.objects.in_bulk(set([user_id for course_id, user_id in rows]))
+        for course_id, user_id in rows:
+            members[course_id].append(users[user_id])
+    return members
+
+@transaction.commit_on_success
+def tick(now=None):
+    """
+    Applies every activation and deactivation scheduled for ``now`` or 
+    before, defaulting to the current time. Takes one UPDATE per kind of 
+    change however many courses and lessons are due, then drops the cached
+    fragments of the courses affected and queues notices of the 
+    activations to their members as one batch.
+    
+    Returns a dictionary of the number of courses and lessons activated and
+    deactivated.
+    """
+    now = now or datetime.now()
+    courses_activated = _flip(Course, 'activate_at', now, True)
+    courses_deactivated = _flip(Course, 'deactivate_at', now, False)
+    lessons_activated = _flip(Lesson, 'activate_at', now, True)
+    lessons_deactivated = _flip(Lesson, 'deactivate_at', now, False)
+    
+    changed = set([course_id for rows in (courses_activated, 
+        courses_deactivated, lessons_activated, lessons_deactivated) 
+        for pk, course_id in rows])
+    if changed:
+        Course.objects.filter(pk__in=changed).update(modified=now)
+    for course_id in changed:
+        cache.bump_generation(course_id)
+    
+    # Nobody is told of an activation whose window closed in the same tick
+    closed = set([pk for pk, course_id in courses_deactivated])
+    courses_activated = [row for row in courses_activated 
+                         if row[0] not in closed]
+    closed = set([pk for pk, course_id in lessons_deactivated])
+    lessons_activated = [row for row in lessons_activated 
+                         if row[0] not in closed]
+    
+    batch = []
+    if courses_activated:
+        course_ids = [pk for pk, course_id in courses_activated]
+        courses = Course.objects.in_bulk(course_ids)
+        members = _members(course_ids, with_teachers=True)
+        for course_id in course_ids:
+            batch.append((members[course_id], "course_activated", 
+                          {'course': courses[course_id]}))
+    if lessons_activated:
+        lessons = Lesson.objects.select_related('course').in_bulk(
+            [pk for pk, course_id in lessons_activated])
+        members = _members(set([course_id for pk, course_id in 
+                                lessons_activated]), with_teachers=False)
+        for lesson in lessons.values():
+            batch.append((members[lesson.course_id], "course_lesson_activated", 
+                          {'course': lesson.course, 'lesson': lesson}))
+    notices.send_many([notice for notice in batch if notice[0]])
+    
+    return {
+        'courses_activated': len(courses_activated),
+        'courses_deactivated': len(courses_deactivated),
+        'lessons_activated': len(lessons_activated),
+        'lessons_deactivated': len(lessons_deactivated),
+    }
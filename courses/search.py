@@ -0,0 +1,330 @@
+import math
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from courses.models import Course, Lesson, Teachership, Enrollment
+
+# A dotted path to a ``SearchBackend`` subclass, or 'auto' to pick one for the
+# database in use. Search is disabled, and nothing indexed, if it isn't set.
+COURSE_SEARCH_BACKEND = getattr(settings, 'COURSE_SEARCH_BACKEND', None)
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Relative weights of matches in titles and descriptions
+TITLE_WEIGHT, DESCRIPTION_WEIGHT = 4.0, 1.0
+
+def object_kind(obj):
+    if isinstance(obj, Lesson):
+        return 'lesson'
+    return 'course'
+
+def _course_id(obj):
+    if isinstance(obj, Lesson):
+        return obj.course_id
+    return obj.pk
+
+def _visibility_sql(user):
+    """
+    Returns a WHERE clause and its parameters restricting rows joined to the
+    course table as ``c`` and, for lessons, the lesson table as ``l``, to
+    those which ``course_detail`` and ``lesson_detail`` would show ``user``.
+    """
+    qn = connection.ops.quote_name
+    tables = {
+        'teachership': qn(Teachership._meta.db_table),
+        'enrollment': qn(Enrollment._meta.db_table),
+    }
+    if user.is_authenticated():
+        teaching = "c.id IN (SELECT course_id FROM %(teachership)s WHERE " \
+            "teacher_id = %%s AND is_active = %%s)" % tables
+        accessible = "(c.privacy = 'P' OR c.privacy = 'R' OR (c.privacy = 'E' " \
+            "AND c.id IN (SELECT course_id FROM %(enrollment)s WHERE " \
+            "student_id = %%s AND is_active = %%s)))" % tables
+        params = [user.pk, True, user.pk, True]
+    else:
+        teaching = "1 = 0"
+        accessible = "c.privacy = 'P'"
+        params = []
+    return "(%(teaching)s OR (c.activated IS NOT NULL AND (s.kind = 'course' " \
+        "OR (%(accessible)s AND l.activated IS NOT NULL))))" % {
+            'teaching': teaching, 'accessible': accessible}, params
+
+
+class SearchBackend(object):
+    """
+    The interface for search backends. ``search`` returns a list of
+    ``(kind, pk)`` pairs, best match first, where kind is ``'course'`` or
+    ``'lesson'``.
+    """
+    def index(self, obj):
+        raise NotImplementedError
+
+    def remove(self, obj):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def search(self, query, user, offset=0, limit=20):
+        raise NotImplementedError
+
+
+class SQLSearchBackend(SearchBackend):
+    """
+    Shared code for backends keeping their index in a ``courses_search`` table
+    with ``kind``, ``object_id`` and ``course_id`` columns.
+    """
+    table = 'courses_search'
+    _ready = False
+
+    def table_exists(self, cursor):
+        raise NotImplementedError
+
+    def create_table(self, cursor):
+        raise NotImplementedError
+
+    def prepare(self):
+        """
+        Creates the table unless it exists already. The check comes first as
+        Python's sqlite3 module commits the transaction in progress before
+        any CREATE statement, even one with IF NOT EXISTS.
+        """
+        cursor = connection.cursor()
+        if not self._ready:
+            if not self.table_exists(cursor):
+                self.create_table(cursor)
+            self.__class__._ready = True
+        return cursor
+
+    def _cursor(self):
+        return self.prepare()
+
+    def remove(self, obj):
+        self._cursor().execute("DELETE FROM %s WHERE kind = %%s AND object_id = %%s"
+            % self.table, [object_kind(obj), obj.pk])
+        transaction.commit_unless_managed()
+
+    def clear(self):
+        self._cursor().execute("DELETE FROM %s" % self.table)
+        transaction.commit_unless_managed()
+
+    def _search(self, rank, match, query, user, offset, limit, rank_params=()):
+        visible, params = _visibility_sql(user)
+        qn = connection.ops.quote_name
+        cursor = self._cursor()
+        cursor.execute("SELECT s.kind, s.object_id FROM %(search)s s "
+            "JOIN %(course)s c ON c.id = s.course_id "
+            "LEFT JOIN %(lesson)s l ON s.kind = 'lesson' AND l.id = s.object_id "
+            "WHERE %(match)s AND %(visible)s ORDER BY %(rank)s LIMIT %%s OFFSET %%s" % {
+                'search': self.table,
+                'course': qn(Course._meta.db_table),
+                'lesson': qn(Lesson._meta.db_table),
+                'match': match, 'visible': visible, 'rank': rank,
+            }, [query] + params + list(rank_params) + [limit, offset])
+        return cursor.fetchall()
+
+
+class SQLiteSearchBackend(SQLSearchBackend):
+    """
+    Uses an SQLite FTS5 virtual table, ranked by BM25.
+    """
+    def table_exists(self, cursor):
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND "
+                       "name = %s", [self.table])
+        return bool(cursor.fetchall())
+
+    def create_table(self, cursor):
+        cursor.execute("CREATE VIRTUAL TABLE %s USING fts5("
+            "kind UNINDEXED, object_id UNINDEXED, course_id UNINDEXED, "
+            "title, description)" % self.table)
+
+    def index(self, obj):
+        cursor = self._cursor()
+        cursor.execute("DELETE FROM %s WHERE kind = %%s AND object_id = %%s"
+            % self.table, [object_kind(obj), obj.pk])
+        cursor.execute("INSERT INTO %s (kind, object_id, course_id, title, "
+            "description) VALUES (%%s, %%s, %%s, %%s, %%s)" % self.table,
+            [object_kind(obj), obj.pk, _course_id(obj), obj.title, obj.description])
+        transaction.commit_unless_managed()
+
+    def search(self, query, user, offset=0, limit=20):
+        # Quote every word so that user input can't use FTS query syntax
+        terms = " ".join(['"%s"' % word for word in WORD_RE.findall(query)])
+        if not terms:
+            return []
+        # FTS5's hidden column is named after the table, not the alias
+        return self._search("bm25(%s, 0, 0, 0, %s, %s)" % (self.table, 
+                TITLE_WEIGHT, DESCRIPTION_WEIGHT),
+            "%s MATCH %%s" % self.table, terms, user, offset, limit)
+
+
+class PostgreSQLSearchBackend(SQLSearchBackend):
+    """
+    Uses a GIN-indexed ``tsvector`` column, ranked by ``ts_rank``.
+    """
+    def table_exists(self, cursor):
+        cursor.execute("SELECT 1 FROM pg_class WHERE relname = %s", [self.table])
+        return bool(cursor.fetchall())
+
+    def create_table(self, cursor):
+        cursor.execute("CREATE TABLE %s (kind varchar(6) NOT NULL, "
+            "object_id integer NOT NULL, course_id integer NOT NULL, "
+            "document tsvector NOT NULL, PRIMARY KEY (kind, object_id))"
+            % self.table)
+        cursor.execute("CREATE INDEX %s_document ON %s USING gin(document)" %
+            (self.table, self.table))
+        transaction.commit_unless_managed()
+
+    def index(self, obj):
+        cursor = self._cursor()
+        cursor.execute("DELETE FROM %s WHERE kind = %%s AND object_id = %%s"
+            % self.table, [object_kind(obj), obj.pk])
+        cursor.execute("INSERT INTO %s (kind, object_id, course_id, document) "
+            "VALUES (%%s, %%s, %%s, "
+            "setweight(to_tsvector('english', %%s), 'A') || "
+            "setweight(to_tsvector('english', %%s), 'D'))" % self.table,
+            [object_kind(obj), obj.pk, _course_id(obj), obj.title, obj.description])
+        transaction.commit_unless_managed()
+
+    def search(self, query, user, offset=0, limit=20):
+        return self._search("ts_rank('{%s, 0, 0, %s}', s.document, "
+                "plainto_tsquery('english', %%s)) DESC" % (DESCRIPTION_WEIGHT /
+                TITLE_WEIGHT, 1.0),
+            "s.document @@ plainto_tsquery('english', %s)", query, user,
+            offset, limit, rank_params=[query])
+
+
+class MemorySearchBackend(SearchBackend):
+    """
+    A per-process inverted index ranked by TF-IDF, for tests and development.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.postings = {}
+        self.documents = {}
+
+    def index(self, obj):
+        self.remove(obj)
+        key = (object_kind(obj), obj.pk)
+        terms = {}
+        for text, weight in ((obj.title, TITLE_WEIGHT),
+                             (obj.description, DESCRIPTION_WEIGHT)):
+            for word in WORD_RE.findall(text.lower()):
+                terms[word] = terms.get(word, 0) + weight
+        for word, weight in terms.items():
+            self.postings.setdefault(word, {})[key] = weight
+        self.documents[key] = terms.keys()
+
+    def remove(self, obj):
+        key = (object_kind(obj), obj.pk)
+        for word in self.documents.pop(key, ()):
+            self.postings[word].pop(key, None)
+            if not self.postings[word]:
+                del self.postings[word]
+
+    def search(self, query, user, offset=0, limit=20):
+        scores = {}
+        for word in WORD_RE.findall(query.lower()):
+            postings = self.postings.get(word, {})
+            if not postings:
+                continue
+            idf = math.log(1.0 + len(self.documents) / float(len(postings)))
+            for key, weight in postings.items():
+                scores[key] = scores.get(key, 0) + weight * idf
+        ranked = [key for score, key in
+                  sorted([(-score, key) for key, score in scores.items()])]
+        visible = self._visible(ranked, user)
+        return [key for key in ranked if key in visible][offset:offset + limit]
+
+    def _visible(self, keys, user):
+        course_ids = [pk for kind, pk in keys if kind == 'course']
+        lesson_ids = [pk for kind, pk in keys if kind == 'lesson']
+        lessons = Lesson.objects.in_bulk(lesson_ids)
+        courses = Course.objects.in_bulk(course_ids +
+            [lesson.course_id for lesson in lessons.values()])
+        visible = set()
+        for pk in course_ids:
+            if pk in courses and (courses[pk].activated or
+                                  courses[pk].roles_for(user).is_teacher):
+                visible.add(('course', pk))
+        for pk, lesson in lessons.items():
+            course = courses[lesson.course_id]
+            roles = course.roles_for(user)
+            accessible = course.privacy == 'P' or \
+                (course.privacy == 'R' and user.is_authenticated()) or \
+                (course.privacy == 'E' and roles.is_student)
+            if roles.is_teacher or (course.activated and accessible and
+                                    lesson.activated):
+                visible.add(('lesson', pk))
+        return visible
+
+
+_backend = None
+
+def get_backend():
+    """
+    Returns the configured backend, or ``None`` if search is disabled.
+    """
+    global _backend
+    if _backend is None and COURSE_SEARCH_BACKEND:
+        path = COURSE_SEARCH_BACKEND
+        if path == 'auto':
+            engine = getattr(settings, 'DATABASE_ENGINE', '')
+            if engine == 'sqlite3':
+                path = 'courses.search.SQLiteSearchBackend'
+            elif engine.startswith('postgresql'):
+                path = 'courses.search.PostgreSQLSearchBackend'
+            else:
+                path = 'courses.search.MemorySearchBackend'
+        module, name = path.rsplit('.', 1)
+        _backend = getattr(__import__(module, {}, {}, [name]), name)()
+    return _backend
+
+def create_table():
+    """
+    Creates the table of the configured backend, if it keeps its index in 
+    one which doesn't exist yet.
+    """
+    backend = get_backend()
+    if isinstance(backend, SQLSearchBackend):
+        backend.prepare()
+
+def search(query, user, page=1, per_page=20):
+    """
+    Returns a ``(results, has_next)`` pair, where ``results`` lists the 
+    courses and lessons on ``page`` of those matching ``query`` which 
+    ``user`` may see, best match first.
+    """
+    backend = get_backend()
+    if backend is None or not query.strip():
+        return [], False
+    keys = backend.search(query, user, offset=(page - 1) * per_page,
+                          limit=per_page + 1)
+    has_next = len(keys) > per_page
+    keys = keys[:per_page]
+    objects = {
+        'course': Course.objects.in_bulk([pk for kind, pk in keys if kind == 'course']),
+        'lesson': Lesson.objects.select_related('course').in_bulk(
+            [pk for kind, pk in keys if kind == 'lesson']),
+    }
+    return [objects[kind][pk] for kind, pk in keys if pk in objects[kind]], has_next
+
+def rebuild():
+    """
+    Clears the index and indexes every course and lesson again, returning
+    the number of objects indexed.
+    """
+    backend = get_backend()
+    if backend is None:
+        return 0
+    backend.clear()
+    count = 0
+    for model in (Course, Lesson):
+        for obj in model.objects.all().iterator():
+            backend.index(obj)
+            count += 1
+    return count
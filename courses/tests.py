@@ -0,0 +1,305 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpRequest, HttpResponse
+from django.test import TestCase, TransactionTestCase
+
+from courses import feedback, middleware, models, queryplans, routers, views
+from courses.middleware import ReadYourWritesMiddleware, \
+    COURSE_REPLICA_PIN_COOKIE
+from courses.models import Course, EnrollmentRequest, Lesson
+from courses.search import MemorySearchBackend, SQLiteSearchBackend, \
+    PostgreSQLSearchBackend
+from courses.utils import db_vendor, make_etag, save_with_retry
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        self.modified = datetime(2009, 3, 12)
+        self.etag = make_etag('course', 1, self.modified.isoformat())
+        self.request = HttpRequest()
+        self.request.method = 'GET'
+        self.request.META['HTTP_IF_NONE_MATCH'] = self.etag
+        
+    def test_not_modified(self):
+        response = views._not_modified(self.request, self.etag, self.modified)
+        self.assertEqual(response.status_code, 304)
+        
+    def test_pending_feedback_is_rendered(self):
+        # e.g. left by a failed action which redirected back to the page
+        feedback.add(self.request, "You may not enroll in a course you teach")
+        self.assertEqual(views._not_modified(self.request, self.etag, 
+                                             self.modified), None)
+        response = views._set_conditional_headers(HttpResponse(), self.etag, 
+            self.modified, True, public=True, max_age=60)
+        self.failIf(response.has_header('ETag'))
+        self.failIf(response.has_header('Last-Modified'))
+        self.failUnless('no-store' in response['Cache-Control'])
+        self.failIf('public' in response['Cache-Control'])
+
+
+class LessonSlugTest(TestCase):
+    def setUp(self):
+        self.courses = []
+        for title in ("Algebra", "Geometry"):
+            course = Course(title=title, description="A course")
+            course.save()
+            self.courses.append(course)
+            
+    def test_slugs_unique_across_courses(self):
+        first = Lesson(course=self.courses[0], title="Week 1", description="")
+        first.save()
+        second = Lesson(course=self.courses[1], title="Week 1", description="")
+        second.save()
+        added = self.courses[1].add_lessons([
+            Lesson(title="Week 1", description="")])
+        self.assertEqual([first.slug, second.slug, added[0].slug], 
+                         ["week-1", "week-1-2", "week-1-3"])
+        
+    def test_retry_after_slug_is_claimed(self):
+        lesson = Lesson(course=self.courses[0], title="Week 1", description="", 
+                        position=1)
+        Lesson.allocate_slugs([lesson])
+        # Another course's lesson takes the slug before this one is saved
+        Lesson(course=self.courses[1], title="Week 1", description="").save()
+        save_with_retry(lesson)
+        self.assertEqual(lesson.slug, "week-1-2")
+
+
+class ReorderLessonsTest(TestCase):
+    def setUp(self):
+        self.course = Course(title="Algebra", description="A course")
+        self.course.save()
+        self.lessons = self.course.add_lessons([
+            Lesson(title="Week %d" % i, description="") for i in range(1, 8)])
+        self.batch_size = models.LESSON_REORDER_BATCH_SIZE
+        models.LESSON_REORDER_BATCH_SIZE = 3
+        
+    def tearDown(self):
+        models.LESSON_REORDER_BATCH_SIZE = self.batch_size
+        
+    def test_reorder_in_batches(self):
+        self.course.reorder_lessons(range(7, 0, -1))
+        self.assertEqual([lesson.title for lesson in 
+                          Lesson.objects.filter(course=self.course)], 
+                         ["Week %d" % i for i in range(7, 0, -1)])
+        
+    def test_invalid_positions(self):
+        self.assertRaises(ValueError, self.course.reorder_lessons, [1, 1, 2])
+        self.assertEqual(list(Lesson.objects.filter(course=self.course
+            ).values_list('position', flat=True)), range(1, 8))
+
+
+class SearchBackendTest(TestCase):
+    def setUp(self):
+        self.backend_class = {
+            'sqlite': SQLiteSearchBackend,
+            'postgresql': PostgreSQLSearchBackend,
+        }.get(db_vendor(connection))
+        if self.backend_class is not None:
+            # The search table belongs to the database of an earlier run, and
+            # creating it may commit, so it is done before there's any data
+            self.backend_class._ready = False
+            self.backend_class().prepare()
+        now = datetime.now()
+        self.course = Course(title="Organic chemistry", 
+                             description="Molecules and their reactions",
+                             activated=now)
+        self.course.save()
+        self.private = Course(title="Inorganic chemistry", 
+                              description="Salts and metals", privacy='E',
+                              activated=now)
+        self.private.save()
+        self.lesson = Lesson(course=self.private, title="Chemistry lab", 
+                             description="Titrating acids")
+        self.lesson.save()
+        self.draft = Course(title="Physical chemistry", 
+                            description="Thermodynamics")
+        self.draft.save()
+        self.user = User.objects.create_user('student', 'student@example.com', 
+                                             'secret')
+        self.private.enroll(self.user)
+        self.draft.appoint_teacher(self.user)
+        self.stranger = User.objects.create_user('stranger', 
+                                                 'stranger@example.com', 
+                                                 'secret')
+        
+    def assertFinds(self, backend):
+        for obj in (self.course, self.private, self.lesson, self.draft):
+            backend.index(obj)
+        public = set([('course', self.course.pk), ('course', self.private.pk)])
+        for user in (AnonymousUser(), self.stranger):
+            self.assertEqual(set(backend.search("chemistry", user)), public)
+        # Students see lessons of courses they're enrolled in, and teachers 
+        # their courses before they're activated
+        self.assertEqual(set(backend.search("chemistry", self.user)), 
+                         public | set([('lesson', self.lesson.pk), 
+                                       ('course', self.draft.pk)]))
+        self.assertEqual(list(backend.search("astronomy", self.user)), [])
+        
+    def test_memory_backend(self):
+        self.assertFinds(MemorySearchBackend())
+        
+    def test_sql_backend(self):
+        if self.backend_class is not None:
+            self.assertFinds(self.backend_class())
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        self.debug, settings.DEBUG = settings.DEBUG, False
+        middleware.reset_stats()
+        
+    def tearDown(self):
+        settings.DEBUG = self.debug
+        middleware.reset_stats()
+        
+    def test_records_without_debug(self):
+        request = HttpRequest()
+        budget = middleware.QueryBudgetMiddleware()
+        budget.process_view(request, views.courses, (), {})
+        list(Course.objects.all())
+        list(Lesson.objects.all())
+        budget.process_response(request, HttpResponse())
+        stats = middleware.get_stats()['courses.views.courses']
+        self.assertEqual((stats['requests'], stats['queries']), (1, 2))
+        
+    def test_nested_budgets(self):
+        @middleware.query_budget(1)
+        def count_courses():
+            return Course.objects.count()
+        outer = middleware.start_recording()
+        count_courses()
+        Lesson.objects.count()
+        self.assertEqual(len(middleware.stop_recording(outer)), 2)
+        self.assertEqual(middleware.get_stats()['courses.tests.count_courses'
+            ]['queries'], 1)
+
+
+class QueryPlanTest(TransactionTestCase):
+    """
+    Fails if the plan of any of the app's key queries reads a whole table,
+    e.g. because an index in ``courses.indexes`` has gone missing.
+    
+    Python's sqlite3 module commits before an EXPLAIN, so the data can't be
+    rolled back and is flushed after each test instead.
+    """
+    def setUp(self):
+        self.teacher = User.objects.create_user('teacher', 
+                                                'teacher@example.com', 'secret')
+        students = [User.objects.create_user('student%d' % i, 
+                                             'student%d@example.com' % i, 
+                                             'secret') for i in range(5)]
+        for i in range(3):
+            course = Course(title="Course %d" % i, description="A course", 
+                            moderated=True, activated=datetime.now())
+            course.save()
+            course.appoint_teacher(self.teacher)
+            course.enroll_many(students[:3])
+            course.add_lessons([Lesson(title="Lesson %d.%d" % (i, j), 
+                                       description="A lesson") 
+                                for j in range(3)])
+            for student in students[3:]:
+                EnrollmentRequest(requestor=student, course=course, 
+                                  status='R').save()
+        self.course = course
+        if db_vendor(connection) == 'postgresql':
+            # Tables this small would be read whole whatever the indexes
+            connection.cursor().execute("SET enable_seqscan TO off")
+            
+    def tearDown(self):
+        if db_vendor(connection) == 'postgresql':
+            connection.cursor().execute("SET enable_seqscan TO on")
+        call_command('flush', verbosity=0, interactive=False)
+        
+    def test_no_full_scans(self):
+        for name, plan, scans in queryplans.check(self.course, self.teacher):
+            self.assertEqual(scans, [], "%s reads a whole table:\n%s" % 
+                             (name, "\n".join(plan)))
+            
+    def test_full_scan_is_caught(self):
+        # No index covers descriptions, so this has to read every course
+        plan = queryplans.explain(Course.objects.filter(description="A course"
+            ).order_by())
+        self.failUnless(queryplans.full_scans(plan), "\n".join(plan))
+
+
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        self.replicas = routers.COURSE_DATABASE_REPLICAS
+        routers.COURSE_DATABASE_REPLICAS = ('replica',)
+        routers.unpin()
+        self.router = routers.ReplicaRouter()
+        self.middleware = ReadYourWritesMiddleware()
+        
+    def tearDown(self):
+        routers.COURSE_DATABASE_REPLICAS = self.replicas
+        routers.unpin()
+        
+    def request(self, cookies=None):
+        request = HttpRequest()
+        request.COOKIES = cookies or {}
+        self.middleware.process_request(request)
+        return request
+        
+    def test_reads_go_to_replica(self):
+        self.request()
+        self.assertEqual(self.router.db_for_read(Course), 'replica')
+        self.assertEqual(self.router.db_for_read(User), None)
+        
+    def test_reads_follow_writes_to_primary(self):
+        request = self.request()
+        self.assertEqual(self.router.db_for_write(Course), 
+                         routers.COURSE_PRIMARY_DATABASE)
+        self.assertEqual(self.router.db_for_read(Course), 
+                         routers.COURSE_PRIMARY_DATABASE)
+        response = self.middleware.process_response(request, HttpResponse())
+        self.failUnless(COURSE_REPLICA_PIN_COOKIE in response.cookies)
+        
+        # The user's next request still reads from the primary
+        self.request({COURSE_REPLICA_PIN_COOKIE: 
+                      response.cookies[COURSE_REPLICA_PIN_COOKIE].value})
+        self.assertEqual(self.router.db_for_read(Course), 
+                         routers.COURSE_PRIMARY_DATABASE)
+        
+    def test_raw_writes_pin_to_primary(self):
+        self.request()
+        routers.primary_connection()
+        self.failUnless(routers.wrote())
+        self.assertEqual(self.router.db_for_read(Course), 
+                         routers.COURSE_PRIMARY_DATABASE)
+        
+    def test_pin_expires(self):
+        self.request({COURSE_REPLICA_PIN_COOKIE: "0"})
+        self.assertEqual(self.router.db_for_read(Course), 'replica')
+
+
+class ReplicaDatabaseTest(TransactionTestCase):
+    """
+    Reads and writes through real databases when the settings have replicas,
+    such as the two SQLite databases in ``ReplicaRouter``'s docstring, and
+    does nothing otherwise. The replica's connection only sees committed 
+    rows, hence no test transaction.
+    """
+    def setUp(self):
+        routers.unpin()
+        
+    def tearDown(self):
+        routers.unpin()
+        
+    def test_queries_reach_routed_databases(self):
+        if not routers.COURSE_DATABASE_REPLICAS:
+            return
+        course = Course(title="Algebra", description="A course")
+        course.save()
+        self.assertEqual(course._state.db, routers.COURSE_PRIMARY_DATABASE)
+        # Having written, the thread reads from the primary
+        self.assertEqual(Course.objects.get(pk=course.pk)._state.db, 
+                         routers.COURSE_PRIMARY_DATABASE)
+        routers.unpin()
+        course = Course.objects.get(pk=course.pk)
+        self.failUnless(course._state.db in routers.COURSE_DATABASE_REPLICAS)
+        self.assertEqual(course.title, "Algebra")
@@ -7,26 +7,35 @@ urlpatterns = patterns('',
 
     ### Temp ###
     url(r'^$', views.courses, name="course_list"),
+    url(r'^(?P<ajax>xml|json)/$', views.courses, name="course_list_ajax"),
+    url(r'^search/$', views.search, name="course_search"),
+    url(r'^search/(?P<ajax>xml|json)/$', views.search, name="course_search_ajax"),
+    url(r'^query-stats/$', views.query_stats, name="course_query_stats"),
     
     ### Course actions ###
     url(r'^create/$', views.course, name="course_create"),
     url(r'^(?P<course_slug>[-\w]+)/actions/edit/$', views.course, name="course_edit"),
-    url(r'^(?P<course_slug>[-\w]+)/actions/(?P<action>activate|deactivate|reorder)/$', views.course_actions, name="course_actions"),
+    url(r'^(?P<course_slug>[-\w]+)/actions/(?P<action>activate|deactivate|reorder|move)/$', views.course_actions, name="course_actions"),
     url(r'^(?P<course_slug>[-\w]+)/actions/(?P<action>enroll|unenroll)/$', views.enrollment, name="course_enrollment"),        
     url(r'^(?P<course_slug>[-\w]+)/actions/add-lesson/$', views.lesson, name="course_lesson_create"),
     url(r'^(?P<course_slug>[-\w]+)/teachers/(?P<action>invite|remove)/$', views.teachership, name="course_teachership"),
     
     ### Course actions AJAX ###
-    url(r'^(?P<course_slug>[-\w]+)/actions/(?P<action>activate|deactivate|reorder)/(?P<ajax>xml|json)/$', views.course_actions, name="course_actions_ajax"),
+    url(r'^(?P<course_slug>[-\w]+)/actions/(?P<action>activate|deactivate|reorder|move)/(?P<ajax>xml|json)/$', views.course_actions, name="course_actions_ajax"),
     url(r'^(?P<course_slug>[-\w]+)/actions/(?P<action>enroll|unenroll)/(?P<ajax>xml|json)/$', views.enrollment, name="course_enrollment_ajax"),        
     url(r'^(?P<course_slug>[-\w]+)/teachers/(?P<action>invite|remove)/(?P<ajax>xml|json)/$', views.teachership, name="course_teachership_ajax"),
+    url(r'^(?P<course_slug>[-\w]+)/teachers/candidates/(?P<ajax>xml|json)/$', views.teacher_candidates, name="course_teacher_candidates_ajax"),
+    url(r'^(?P<course_slug>[-\w]+)/students/export/(?P<ajax>xml|json)/$', views.roster_export, name="course_roster_export"),
     
     ### Teachership invitations and enrollment requests ###
     url(r'^requests/$', views.enrollment_requests, name="course_enrollment_request_list"),
+    url(r'^requests/(?P<ajax>xml|json)/$', views.enrollment_requests, name="course_enrollment_request_list_ajax"),
+    url(r'^requests/actions/(?P<action>accept|decline)/$', views.enrollment_responses, name="course_enrollment_responses"),
     url(r'^requests/(?P<enrollment_request_uuid>[-\w]+)/(?P<action>accept|decline)/$', views.enrollment_response, name="course_enrollment_response"),
     url(r'^invitations/(?P<teachership_invitation_uuid>[-\w]+)/(?P<action>accept|decline)/$', views.teachership_response, name="course_teachership_response"),
     
     ### Teachership invitations and enrollment requests AJAX ### 
+    url(r'^requests/actions/(?P<action>accept|decline)/(?P<ajax>xml|json)/$', views.enrollment_responses, name="course_enrollment_responses_ajax"),
     url(r'^requests/(?P<enrollment_request_uuid>[-\w]+)/(?P<action>accept|decline)/(?P<ajax>xml|json)/$', views.enrollment_response, name="course_enrollment_response_ajax"),
     url(r'^invitations/(?P<teachership_invitation_uuid>[-\w]+)/(?P<action>accept|decline)/(?P<ajax>xml|json)/$', views.teachership_response, name="course_teachership_response_ajax"),
     
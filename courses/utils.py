@@ -1,27 +1,43 @@
+import binascii
+import os
 import re
+import time
 import unicodedata
+from datetime import datetime
 from htmlentitydefs import name2codepoint
 
 from django.core.serializers import serialize
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db.models.query import QuerySet
-from django.db.models import CharField
-from django.http import HttpResponse
+from django.db import connection as default_connection, transaction, \
+    IntegrityError
+from django.db.models import CharField, Q, SubfieldBase
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import http_date
 from django.utils import simplejson
 from django.utils.functional import Promise 
 from django.utils.encoding import force_unicode 
+from django.utils.html import escape
 
 try:
     import uuid
 except ImportError:
     from django.utils import uuid
 
+from courses.routers import primary_connection
+
 ### AJAX response utils ###
 
-class LazyEncoder(simplejson.JSONEncoder):
+class LazyEncoder(DjangoJSONEncoder):
     def default(self, obj):
         if isinstance(obj, Promise):
             return force_unicode(obj)
-        return obj
+        return super(LazyEncoder, self).default(obj)
+
+# Built once rather than per response, with no whitespace between tokens
+_compact_encoder = LazyEncoder(separators=(',', ':'))
 
 class JSONResponse(HttpResponse):
     """
@@ -45,23 +61,321 @@ class XMLResponse(HttpResponse):
             content = object
         super(XMLResponse, self).__init__(content, mimetype='application/xml')
 
+def _pk_chunks(queryset, chunk_size):
+    """
+    Yields the objects of ``queryset`` in primary key order, fetching 
+    ``chunk_size`` at a time with a query starting after the last key seen.
+    The database drivers read each result in full, so this, not 
+    ``iterator()``, is what bounds memory.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        qs = queryset
+        if last is not None:
+            qs = qs.filter(pk__gt=last)
+        chunk = list(qs[:chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1].pk
+
+def _serialized_chunks(format, objects, chunk_size):
+    """
+    Serializes ``objects`` to ``format`` ``chunk_size`` at a time, yielding a
+    complete document for each chunk. Querysets are read a chunk at a time
+    by primary key range, so that their results are never held in full.
+    """
+    if isinstance(objects, QuerySet):
+        objects = _pk_chunks(objects, chunk_size)
+    chunk = []
+    for obj in objects:
+        chunk.append(obj)
+        if len(chunk) >= chunk_size:
+            yield serialize(format, chunk)
+            chunk = []
+    if chunk:
+        yield serialize(format, chunk)
+
+def _stream_json(objects, chunk_size):
+    yield "["
+    separator = ""
+    for document in _serialized_chunks('json', objects, chunk_size):
+        yield separator + document.strip()[1:-1]
+        separator = ", "
+    yield "]"
+
+def _stream_xml(objects, chunk_size):
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<django-objects version="1.0">'
+    for document in _serialized_chunks('xml', objects, chunk_size):
+        start = document.index('>', document.index('<django-objects')) + 1
+        yield document[start:document.rindex('</django-objects>')]
+    yield '</django-objects>'
+
+class StreamingJSONResponse(HttpResponse):
+    """
+    Like ``JSONResponse`` for iterables, but serializes and sends the objects
+    a chunk at a time so that memory use doesn't grow with their number.
+    """
+    def __init__(self, objects, chunk_size=500):
+        super(StreamingJSONResponse, self).__init__(
+            _stream_json(objects, chunk_size), mimetype='application/json')
+
+class StreamingXMLResponse(HttpResponse):
+    """
+    Like ``XMLResponse`` for iterables, but serializes and sends the objects 
+    a chunk at a time so that memory use doesn't grow with their number.
+    """
+    def __init__(self, objects, chunk_size=500):
+        super(StreamingXMLResponse, self).__init__(
+            _stream_xml(objects, chunk_size), mimetype='application/xml')
+
+class ValuesJSONResponse(HttpResponse):
+    """
+    Serializes rows from ``values()`` to a JSON list of objects holding just 
+    those fields. This skips model instantiation and the pk/model envelope
+    of ``JSONResponse``, so suits listings which need only a few fields. If 
+    ``fields`` is given, a queryset is projected onto them first.
+    """
+    def __init__(self, rows, fields=None):
+        if fields and isinstance(rows, QuerySet):
+            rows = rows.values(*fields)
+        super(ValuesJSONResponse, self).__init__(
+            _compact_encoder.encode(list(rows)), mimetype='application/json')
+
+class ValuesXMLResponse(HttpResponse):
+    """
+    The XML counterpart of ``ValuesJSONResponse``, which writes each row as 
+    an ``item`` element with a child element per field.
+    """
+    def __init__(self, rows, fields=None, root='objects', item='object'):
+        if fields and isinstance(rows, QuerySet):
+            rows = rows.values(*fields)
+        content = [u'<?xml version="1.0" encoding="utf-8"?>\n<%s>' % root]
+        for row in rows:
+            content.append(u'<%s>' % item)
+            for name, value in row.items():
+                if value is None:
+                    content.append(u'<%s/>' % name)
+                else:
+                    content.append(u'<%s>%s</%s>' % 
+                                   (name, escape(force_unicode(value)), name))
+            content.append(u'</%s>' % item)
+        content.append(u'</%s>' % root)
+        super(ValuesXMLResponse, self).__init__(u''.join(content), 
+                                                mimetype='application/xml')
+
+### Conditional GET ###
+
+def make_etag(*parts):
+    return '"%s"' % md5_constructor(":".join([force_unicode(part).encode('utf-8') 
+                                              for part in parts])).hexdigest()
+
+def not_modified(request, etag, last_modified):
+    """
+    Returns an ``HttpResponseNotModified`` if the request's validators match 
+    ``etag`` or the ``last_modified`` datetime, or ``None`` if the page 
+    should be rendered. Only GET and HEAD requests are considered.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    last_modified = http_date(time.mktime(last_modified.timetuple()))
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        matched = etag in tags or '*' in tags
+    else:
+        matched = request.META.get('HTTP_IF_MODIFIED_SINCE') == last_modified
+    if not matched:
+        return None
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    return response
+
+def set_conditional_headers(response, etag, last_modified, **cache_control):
+    """
+    Sets the validators checked by ``not_modified`` on ``response``, along 
+    with any ``Cache-Control`` directives given as keywords.
+    """
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(time.mktime(last_modified.timetuple()))
+    if cache_control:
+        patch_cache_control(response, **cache_control)
+    patch_vary_headers(response, ('Cookie',))
+    return response
+
+### Transactions ###
+
+def commit_on_success_unless_managed(func):
+    """
+    Like ``transaction.commit_on_success``, but joins the enclosing 
+    transaction if there is one rather than committing it early, so that row 
+    locks taken inside ``func`` are held until the outermost block ends.
+    """
+    def _commit_on_success_unless_managed(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    _commit_on_success_unless_managed.__name__ = func.__name__
+    _commit_on_success_unless_managed.__module__ = func.__module__
+    _commit_on_success_unless_managed.__doc__ = func.__doc__
+    return _commit_on_success_unless_managed
+
+def bulk_insert(model, field_names, rows):
+    """
+    Inserts ``rows``, each a sequence of values for ``field_names``, into the
+    table for ``model`` with a single ``executemany``. No ``save`` methods or
+    signals are run, so callers must fill in everything those would.
+    """
+    if not rows:
+        return
+    connection = primary_connection()
+    opts, qn = model._meta, connection.ops.quote_name
+    fields = [opts.get_field(name) for name in field_names]
+    connection.cursor().executemany(
+        "INSERT INTO %s (%s) VALUES (%s)" % (qn(opts.db_table), 
+            ", ".join([qn(field.column) for field in fields]), 
+            ", ".join(["%s"] * len(fields))), 
+        [[field.get_db_prep_save(value) for field, value in zip(fields, row)] 
+         for row in rows])
+    transaction.set_dirty()
+
+### Keyset pagination ###
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(value, pk):
+    """
+    Encodes a ``(datetime or None, pk)`` position as an opaque URL-safe string.
+    The primary key may be an integer or a UUID string.
+    """
+    if value is None:
+        return "n%s" % pk
+    return "%s%06d.%s" % (value.strftime('%Y%m%d%H%M%S'), value.microsecond, pk)
+
+def decode_cursor(cursor, parse_pk=int):
+    """
+    The inverse of ``encode_cursor``, with the primary key converted by 
+    ``parse_pk``. Raises ``InvalidCursor`` for anything that it could not 
+    have produced.
+    """
+    try:
+        if cursor.startswith('n'):
+            return None, parse_pk(cursor[1:])
+        stamp, pk = cursor.split('.')
+        if len(stamp) != 20:
+            raise ValueError
+        value = datetime(int(stamp[0:4]), int(stamp[4:6]), int(stamp[6:8]),
+                         int(stamp[8:10]), int(stamp[10:12]), int(stamp[12:14]),
+                         int(stamp[14:20]))
+        return value, parse_pk(pk)
+    except (ValueError, TypeError, AttributeError):
+        raise InvalidCursor("Invalid pagination cursor: %r" % cursor)
+
+def keyset_page(queryset, field, after=None, limit=20, include_nulls=False):
+    """
+    Returns ``(objects, next_cursor)`` for the page of ``queryset`` which
+    follows the ``after`` cursor, ordered by the nullable datetime ``field``
+    and then by primary key. Rows where ``field`` is null are only included
+    if ``include_nulls`` is set, and come after all others ordered by primary
+    key. ``next_cursor`` is ``None`` on the last page. A ``values()`` 
+    queryset may be given as long as it includes ``field`` and the primary 
+    key.
+    
+    Each page is a range scan starting at the cursor rather than an OFFSET, 
+    so its cost doesn't depend on how deep the client has paged.
+    """
+    pk_field = queryset.model._meta.pk
+    value, pk = None, None
+    if after:
+        value, pk = decode_cursor(after, _pk_parser(pk_field))
+    objects = []
+    if not (after and value is None):
+        objects = list(keyset_after(queryset, field, value, pk)[:limit + 1])
+    if include_nulls and len(objects) <= limit:
+        qs = queryset.filter(**{'%s__isnull' % field: True})
+        if after and value is None:
+            qs = qs.filter(pk__gt=pk)
+        objects += list(qs.order_by('pk')[:limit + 1 - len(objects)])
+    if len(objects) <= limit:
+        return objects, None
+    objects = objects[:limit]
+    last = objects[-1]
+    if isinstance(last, dict):
+        # values() rows hold the primary key as the database returned it
+        return objects, encode_cursor(last[field], 
+                                      pk_field.to_python(last[pk_field.name]))
+    return objects, encode_cursor(getattr(last, field), last.pk)
+
+def keyset_after(queryset, field, value=None, pk=None):
+    """
+    Returns ``queryset`` ordered as ``keyset_page`` pages it, restricted to 
+    the rows with a non-null ``field`` after the ``(value, pk)`` position, 
+    or from the start if ``value`` is ``None``.
+    """
+    qs = queryset.filter(**{'%s__isnull' % field: False})
+    if value is not None:
+        qs = qs.filter(Q(**{'%s__gt' % field: value}) | 
+                       Q(**{field: value, 'pk__gt': pk}))
+    return qs.order_by(field, 'pk')
+
+def _pk_parser(pk_field):
+    if isinstance(pk_field, UUIDField):
+        return lambda value: unicode(uuid.UUID(value))
+    return int
+
 ### UUID custom field ###
 # Snippet taken from http://www.djangosnippets.org/snippets/335/ on 12 March 2009
 
 class UUIDVersionError(Exception):
     pass
 
+def uuid7():
+    """
+    Returns a time-ordered UUID in the layout of the draft version 7: a 48 bit
+    millisecond timestamp followed by random bits. Keys generated in 
+    sequence sort together, so inserts land at the end of the index rather 
+    than all over it, and no MAC address or clock sequence is looked up.
+    """
+    random = long(binascii.hexlify(os.urandom(10)), 16)
+    value = (long(time.time() * 1000) & 0xFFFFFFFFFFFFL) << 80
+    value |= 0x7L << 76
+    value |= ((random >> 62) & 0xFFFL) << 64
+    value |= 0x2L << 62
+    value |= random & 0x3FFFFFFFFFFFFFFFL
+    return uuid.UUID(int=value)
+
+def db_vendor(connection):
+    """
+    Returns 'postgresql', 'mysql', 'sqlite' or the backend module name for a 
+    database connection.
+    """
+    backend = connection.__class__.__module__.split('.')[-2]
+    for vendor in ('postgresql', 'mysql', 'sqlite'):
+        if backend.startswith(vendor):
+            return vendor
+    return backend
+
 class UUIDField(CharField):
     """ UUIDField for Django, supports all uuid versions which are natively
-        suported by the uuid python module.
+        suported by the uuid python module, plus the time-ordered version 7.
+        
+        With ``storage='native'`` values are stored in a ``uuid`` column on 
+        PostgreSQL and as 16 bytes of binary elsewhere, rather than as 36 
+        characters of text. Values are hyphenated strings in Python either way.
     """
+    __metaclass__ = SubfieldBase
 
-    def __init__(self, verbose_name=None, name=None, auto=True, version=1, node=None, clock_seq=None, namespace=None, **kwargs):
+    def __init__(self, verbose_name=None, name=None, auto=True, version=1, node=None, clock_seq=None, namespace=None, storage='char', **kwargs):
         kwargs['max_length'] = 36
         if auto:
             kwargs['blank'] = True
             kwargs['editable'] = kwargs.get('editable', False)
         self.version = version
+        self.storage = storage
         if version==1:
             self.node, self.clock_seq = node, clock_seq
         elif version==3 or version==5:
@@ -71,6 +385,37 @@ class UUIDField(CharField):
     def get_internal_type(self):
         return CharField.__name__
 
+    def db_type(self, connection=None):
+        if self.storage != 'native':
+            if connection is None:
+                return super(UUIDField, self).db_type()
+            return super(UUIDField, self).db_type(connection=connection)
+        vendor = db_vendor(connection or default_connection)
+        if vendor == 'postgresql':
+            return 'uuid'
+        elif vendor == 'mysql':
+            return 'binary(16)'
+        return 'blob'
+
+    def to_python(self, value):
+        if self.storage != 'native' or value is None or \
+                isinstance(value, unicode):
+            return value
+        if isinstance(value, uuid.UUID):
+            return unicode(value)
+        value = str(value)
+        if len(value) == 16:
+            return unicode(uuid.UUID(bytes=value))
+        return unicode(value)
+
+    def get_db_prep_value(self, value, connection=None, prepared=False):
+        if self.storage != 'native' or value is None or value == '':
+            return value
+        value = uuid.UUID(force_unicode(value))
+        if db_vendor(connection or default_connection) == 'postgresql':
+            return str(value)
+        return buffer(value.bytes)
+
     def create_uuid(self):
         if not self.version or self.version==4:
             return uuid.uuid4()
@@ -82,6 +427,8 @@ class UUIDField(CharField):
             return uuid.uuid3(self.namespace, self.name)
         elif self.version==5:
             return uuid.uuid5(self.namespace, self.name)
+        elif self.version==7:
+            return uuid7()
         else:
             raise UUIDVersionError("UUID version %s is not valid." % self.version)
 
@@ -116,7 +463,78 @@ def slugify(s, entities=False, decimal=False, hexadecimal=False, invalid=None,
     the slug unique for rows where the column 'date' is todays date. `slug_field`
     is the field in the model to match for uniqueness. You can pass a manager
     to use instead of the default one as `manager`.
+    
+    Every existing slug sharing the prefix is fetched in one query and the 
+    first free suffix is then picked in memory.
     """
+    s = _slug_text(s, entities, decimal, hexadecimal)
+    invalid = invalid or []
+    if not instance:
+        return _next_free_slug(s, (), invalid)
+    if not manager:
+        manager = instance.__class__._default_manager
+    qs = manager.filter(**dict(extra_lookup or {}, 
+                               **{'%s__startswith' % slug_field: s}))
+    if instance.pk:
+        qs = qs.exclude(pk=instance.pk)
+    taken = set(qs.values_list(slug_field, flat=True))
+    return _next_free_slug(s, taken, invalid)
+
+def slugify_many(instances, source='title', invalid=None, manager=None, 
+        slug_field='slug', extra_lookup=None, **kwargs):
+    """
+    Assigns unique slugs, made from their ``source`` attribute, to several
+    instances of the same model at once. A single query fetches every slug 
+    that could collide, both with existing rows and within the batch. The 
+    other keywords are as for ``slugify``.
+    
+    Each instance is marked with ``_slug_allocated`` so that a model's 
+    ``save`` may keep the slug rather than allocating another one. Slugs can
+    still be claimed by concurrent inserts before the instances are saved, so
+    save them with ``save_with_retry``.
+    """
+    instances = list(instances)
+    if not instances:
+        return instances
+    invalid = invalid or []
+    if not manager:
+        manager = instances[0].__class__._default_manager
+    bases = [_slug_text(getattr(instance, source), **kwargs) 
+             for instance in instances]
+    prefixes = Q()
+    for base in set(bases):
+        prefixes |= Q(**{'%s__startswith' % slug_field: base})
+    qs = manager.filter(prefixes, **(extra_lookup or {}))
+    pks = [instance.pk for instance in instances if instance.pk]
+    if pks:
+        qs = qs.exclude(pk__in=pks)
+    taken = set(qs.values_list(slug_field, flat=True))
+    for instance, base in zip(instances, bases):
+        slug = _next_free_slug(base, taken, invalid)
+        taken.add(slug)
+        setattr(instance, slug_field, slug)
+        instance._slug_allocated = True
+    return instances
+
+def save_with_retry(instance, attempts=3):
+    """
+    Saves ``instance``, and if a concurrent insert claimed its slug first, 
+    lets the model's ``save`` allocate a fresh one and tries again.
+    """
+    for attempt in range(attempts):
+        sid = transaction.savepoint()
+        try:
+            instance.save()
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            if attempt == attempts - 1:
+                raise
+            instance._slug_allocated = False
+        else:
+            transaction.savepoint_commit(sid)
+            return instance
+
+def _slug_text(s, entities=False, decimal=False, hexadecimal=False):
     s = force_unicode(s)
     if entities:
         s = re.sub('&(%s);' % '|'.join(name2codepoint),
@@ -139,26 +557,11 @@ def slugify(s, entities=False, decimal=False, hexadecimal=False, invalid=None,
     #replace unwanted characters
     s = re.sub(r'[^-a-z0-9]+', '-', s.lower())
     #remove redundant -
-    s = re.sub('-{2,}', '-', s).strip('-')
+    return re.sub('-{2,}', '-', s).strip('-')
 
-    invalid = invalid or []
-    if instance:
-        lookup = extra_lookup or {}
-        if not manager:
-            manager = instance.__class__._default_manager
-    
+def _next_free_slug(s, taken, invalid):
     slug, counter = s, 2 #modified to start numbering at -2 not -1 (Ozan, 22/12/08)
-    while True:
-        if slug in invalid:
-            pass
-        elif not instance:
-            return slug
-        else:
-            lookup[slug_field] = slug
-            qs = manager.filter(**lookup)
-            if instance.pk:
-                qs = qs.exclude(pk=instance.pk)
-            if not qs.count():
-                return slug
+    while slug in invalid or slug in taken:
         slug = "%s-%s" % (s, counter)
         counter += 1
+    return slug
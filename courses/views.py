@@ -1,67 +1,225 @@
 from datetime import datetime
 
-from django.http import HttpResponseRedirect, HttpResponseForbidden
-from django.shortcuts import render_to_response, get_object_or_404, get_list_or_404
+from django.http import HttpResponseRedirect, HttpResponseForbidden, Http404
+from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth.decorators import login_required
-from django.db.models import get_app
+from django.db.models import Q
 from django.conf import settings
+from django.utils.cache import patch_cache_control, patch_vary_headers
 
-from courses.utils import JSONResponse, XMLResponse
+try:
+    import uuid
+except ImportError:
+    from django.utils import uuid
+
+from courses.utils import JSONResponse, XMLResponse, ValuesJSONResponse, \
+    ValuesXMLResponse, StreamingJSONResponse, StreamingXMLResponse, keyset_page, InvalidCursor, commit_on_success_unless_managed, \
+    make_etag, not_modified, set_conditional_headers
 from courses.models import Course, Enrollment, Teachership, Lesson, TeachingInvitation, EnrollmentRequest
 from courses.forms import CourseForm, LessonForm
-
-from friends.models import friend_set_for
-
-try:
-    notification = get_app("notification")
-except ImproperlyConfigured:
-    notification = None
+from courses import feedback, notices
+from courses import search as search_backend
+from courses.middleware import get_stats as get_query_stats
 
 ALLOW_USER_COURSE_CREATION = getattr(settings, 'ALLOW_USER_COURSE_CREATION', True)
 ALLOW_TEACHER_PERMISSION_CASCADE = getattr(settings, 'ALLOW_TEACHER_PERMISSION_CASCADE', True)
+COURSES_PER_PAGE = getattr(settings, 'COURSES_PER_PAGE', 20)
+REQUESTS_PER_PAGE = getattr(settings, 'REQUESTS_PER_PAGE', 50)
+SEARCH_RESULTS_PER_PAGE = getattr(settings, 'SEARCH_RESULTS_PER_PAGE', 20)
+INVITE_CANDIDATES_PER_PAGE = getattr(settings, 'INVITE_CANDIDATES_PER_PAGE', 20)
+
+# Cache-Control directives for course and lesson pages by course privacy
+PRIVATE_CACHE_CONTROL = {'private': True, 'max_age': 0, 'must_revalidate': True}
+# For pages showing feedback, which is shown once and mustn't be kept
+FEEDBACK_CACHE_CONTROL = {'private': True, 'max_age': 0, 'no_store': True}
+COURSE_CACHE_CONTROL = getattr(settings, 'COURSE_CACHE_CONTROL', {
+    'P': {'public': True, 'max_age': 60},
+    'R': PRIVATE_CACHE_CONTROL,
+    'E': PRIVATE_CACHE_CONTROL,
+})
 
+# Fields returned by the AJAX listings
+COURSE_LIST_FIELDS = ('id', 'slug', 'title', 'description', 'privacy', 
+                      'moderated', 'activated', 'student_count', 'lesson_count')
+REQUEST_LIST_FIELDS = ('uuid', 'requestor__username', 'course__slug', 
+                       'course__title', 'status', 'created')
+CANDIDATE_FIELDS = ('id', 'username', 'first_name', 'last_name')
+# Most enrollment requests which may be answered in one POST
+MAX_BULK_RESPONSES = getattr(settings, 'MAX_BULK_RESPONSES', 500)
 
-def _basic_response(user, ajax=False, message="Success!", redirect="/"):
+
+def _basic_response(request, ajax=False, message="Success!", redirect="/"):
     if ajax == 'json':
         return JSONResponse({'result': message}, is_iterable=False)
     elif ajax == 'xml':
         return XMLResponse("<result>%s</result>" % message, is_iterable=False)
     else:
-        user.message_set.create(message=message)
+        feedback.add(request, message)
         return HttpResponseRedirect(redirect)
 
+def _uuid_or_404(value):
+    # Natively stored keys can't even be looked up when malformed
+    try:
+        return unicode(uuid.UUID(value))
+    except ValueError:
+        raise Http404
+
+def _viewer_etag(request, roles, kind, pk, last_modified):
+    if roles.is_teacher:
+        role = "teacher"
+    elif roles.is_student:
+        role = "student"
+    elif request.user.is_authenticated():
+        role = "user"
+    else:
+        role = "anonymous"
+    return make_etag(kind, pk, last_modified.isoformat(), role, 
+                     request.user.pk or "")
+
+def _not_modified(request, etag, last_modified):
+    """
+    Like ``not_modified``, but always has the page rendered if there's 
+    feedback pending, as the browser's copy won't show it.
+    """
+    if feedback.pending(request):
+        return None
+    return not_modified(request, etag, last_modified)
+
+def _set_conditional_headers(response, etag, last_modified, shows_feedback, 
+                             **cache_control):
+    """
+    Like ``set_conditional_headers``, but a page which shows feedback gets no
+    validators and may not be stored, so that it can't be shown again.
+    """
+    if shows_feedback:
+        patch_cache_control(response, **FEEDBACK_CACHE_CONTROL)
+        patch_vary_headers(response, ('Cookie',))
+        return response
+    return set_conditional_headers(response, etag, last_modified, 
+                                   **cache_control)
+
+def _cache_control(request, course, roles):
+    """
+    Returns the ``Cache-Control`` directives for a page of ``course``. Only
+    anonymous viewers get the policy for the course's privacy level, as pages 
+    seen by logged in users carry their details.
+    """
+    if request.user.is_authenticated():
+        return PRIVATE_CACHE_CONTROL
+    return COURSE_CACHE_CONTROL.get(course.privacy, PRIVATE_CACHE_CONTROL)
+
+def _invite_candidates(user, course):
+    """
+    The user's friends who aren't active teachers of the course, as a single 
+    query. Friendships are followed through the reverse relations which the
+    ``friends`` app's ``Friendship`` model gives ``User``.
+    """
+    return User.objects.filter(
+        Q(friends__from_user=user) | Q(_unused___to_user=user)
+    ).exclude(
+        pk__in=Teachership.objects.filter(course=course, is_active=True
+            ).values('teacher')
+    ).distinct()
+
 ### Course-related methods ###
-def courses(request):
-    course_list = get_list_or_404(Course)
+def courses(request, ajax=False):
+    """
+    The course catalog, paged by the ``after`` cursor. It may be filtered by
+    ``privacy`` and lists active courses only unless ``active=0`` is given.
+    """
+    if ajax:
+        course_list = Course.objects.values(*COURSE_LIST_FIELDS)
+    else:
+        course_list = Course.objects.all()
+    privacy = request.GET.get('privacy')
+    if privacy in dict(Course.PRIVACY_CHOICES):
+        course_list = course_list.filter(privacy=privacy)
+    try:
+        course_list, next_cursor = keyset_page(course_list, 'activated', 
+            after=request.GET.get('after'), 
+            limit=COURSES_PER_PAGE, 
+            include_nulls=request.GET.get('active') == '0')
+    except InvalidCursor:
+        raise Http404
+    if ajax:
+        if ajax == 'json':
+            response = ValuesJSONResponse(course_list)
+        else:
+            response = ValuesXMLResponse(course_list, root='courses', 
+                                         item='course')
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
     return render_to_response("courses/courses/list.html", {
-        "courses":  course_list
+        "courses":  course_list,
+        "next_cursor": next_cursor
+    }, context_instance=RequestContext(request))
+
+def search(request, ajax=False):
+    """
+    Ranked search over the courses and lessons the user may see, given the
+    query as ``q`` and paged by ``page``.
+    """
+    if search_backend.get_backend() is None:
+        raise Http404
+    query = request.GET.get('q', '')
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        raise Http404
+    results, has_next = search_backend.search(query, request.user, page=page, 
+                                              per_page=SEARCH_RESULTS_PER_PAGE)
+    if ajax:
+        rows = [{'kind': search_backend.object_kind(obj), 
+                 'title': obj.title, 
+                 'description': obj.description, 
+                 'url': obj.get_absolute_url()} for obj in results]
+        if ajax == 'json':
+            response = ValuesJSONResponse(rows)
+        else:
+            response = ValuesXMLResponse(rows, root='results', item='result')
+        if has_next:
+            response['X-Next-Page'] = str(page + 1)
+        return response
+    return render_to_response("courses/search.html", {
+        'query': query,
+        'results': results,
+        'page': page,
+        'has_next': has_next
     }, context_instance=RequestContext(request))
 
 def course_detail(request, course_slug):
     course = get_object_or_404(Course, slug=course_slug)
-    if not (course.activated or request.user in course.active_teachers()):
-        if request.user:
-            request.user.message_set.create(message="The course you tried to access \
-                is currently inactive so can only be seen by course teachers. \
-                If you are a teacher of this course, please log in to view it.")
-        else:
-            pass #should set a session message
+    roles = course.roles_for(request.user)
+    if not (course.activated or roles.is_teacher):
+        feedback.add(request, "The course you tried to access \
+            is currently inactive so can only be seen by course teachers. \
+            If you are a teacher of this course, please log in to view it.")
         return HttpResponseRedirect(reverse("course_list"))
-        
-    return render_to_response('courses/courses/course.html', {
+    
+    lessons = course.outline()
+    last_modified = max([course.modified] + [l.modified for l in lessons])
+    etag = _viewer_etag(request, roles, 'course', course.pk, last_modified)
+    response = _not_modified(request, etag, last_modified)
+    if response:
+        return response
+    shows_feedback = feedback.pending(request)
+    response = render_to_response('courses/courses/course.html', {
         'course': course,
-        'lesson': course.lesson_set.all(), 
-        'is_teacher': request.user in course.active_teachers(),
-        'is_student': request.user in course.active_students()
+        'lesson': lessons, 
+        'is_teacher': roles.is_teacher,
+        'is_student': roles.is_student
     }, context_instance=RequestContext(request))
+    return _set_conditional_headers(response, etag, last_modified, 
+        shows_feedback, **_cache_control(request, course, roles))
 
 @login_required
 def course(request, course_slug=None):
     if not ALLOW_USER_COURSE_CREATION:
-        request.user.message_set.create(message="Course creation has been \
+        feedback.add(request, "Course creation has been \
             disabled")
         return HttpResponseRedirect(reverse("course_list"))
     if course_slug:
@@ -75,7 +233,7 @@ def course(request, course_slug=None):
         if form.is_valid():
             if course:
                 form.save()
-                request.user.message_set.create(message="Course changes have \
+                feedback.add(request, "Course changes have \
                     been saved")
             else:
                 if form.cleaned_data['privacy'] == u'E':
@@ -83,7 +241,7 @@ def course(request, course_slug=None):
                 course = form.save()
                 t = Teachership(course=course, teacher=request.user, is_owner=True)
                 t.save()
-                request.user.message_set.create(message="Your course has been \
+                feedback.add(request, "Your course has been \
                     created. It will not be visible to other users until you \
                     activate it.")               
             return HttpResponseRedirect(course.get_absolute_url())
@@ -97,36 +255,60 @@ def course(request, course_slug=None):
 @login_required
 def course_actions(request, course_slug, action, ajax=False):
     course = get_object_or_404(Course, slug=course_slug)   
-    if not request.user in course.active_teachers():
-        request.user.mesage_set.create(message="The course you tried to edit may only \
+    if not course.roles_for(request.user).is_teacher:
+        feedback.add(request, "The course you tried to edit may only \
             be edited by its teachers. If you are a teacher of this course, \
             please log in to edit it.")
         return HttpResponseRedirect(reverse("acct_login"))
     if request.method == "POST":
         if action == "activate":
-            course.activated = datetime.now()
-            course.save()
+            course.set_activated(datetime.now())
             message = "This course has now been activated and so may be seen by users"
         elif action == "deactivate":
-            course.activated = None
-            course.save()
+            course.set_activated(None)
             message = "This course has been deactivated and so may no longer be seen by users"
         elif action == "reorder":
-            positions = request.POST.getlist(u"lesson[]")
-            for lesson in course.lesson_set.all():
-                lesson.position = int(positions[lesson.position - 1])
-                lesson.save()
-            message = "Course lessons have been reordered"
-        return _basic_response(user=request.user, ajax=ajax, message=message, 
+            try:
+                course.reorder_lessons(request.POST.getlist(u"lesson[]"))
+                message = "Course lessons have been reordered"
+            except ValueError:
+                message = "The lessons could not be reordered as the new \
+                    positions given were invalid"
+        elif action == "move":
+            lesson = get_object_or_404(Lesson, course=course, 
+                                       slug=request.POST.get(u"lesson"))
+            try:
+                course.move_lesson(lesson, request.POST.get(u"position"))
+                message = "The \"%s\" lesson has been moved" % lesson
+            except (ValueError, TypeError):
+                message = "The \"%s\" lesson could not be moved as the new \
+                    position given was invalid" % lesson
+        return _basic_response(request, ajax=ajax, message=message, 
             redirect=request.META.get('HTTP_REFERER', course.get_absolute_url()))
     else:
         return HttpResponseForbidden("This URI accepts the POST method only")
 
 @login_required
+def roster_export(request, course_slug, ajax='json'):
+    """
+    Every enrollment of the course, active or not, for its teachers. The 
+    roster is streamed a chunk at a time, however large the course.
+    """
+    course = get_object_or_404(Course, slug=course_slug)
+    if not course.roles_for(request.user).is_teacher:
+        return HttpResponseForbidden("Only teachers of this course may export \
+            its roster")
+    enrollments = Enrollment.objects.filter(course=course)
+    if ajax == 'json':
+        return StreamingJSONResponse(enrollments)
+    return StreamingXMLResponse(enrollments)
+
+@login_required
+@commit_on_success_unless_managed
 def enrollment(request, course_slug, action, ajax=False):
     course = get_object_or_404(Course, slug=course_slug)
-    if request.user in course.active_teachers():
-        return _basic_response(user=request.user, ajax=ajax, 
+    if course.roles_for(request.user).is_teacher:
+        return _basic_response(request, ajax=ajax, 
             message="You may not enroll in a course which you teach", 
             redirect=request.META.get('HTTP_REFERER', course.get_absolute_url()))    
     if request.method == "POST":
@@ -134,11 +316,10 @@ def enrollment(request, course_slug, action, ajax=False):
             if course.moderated:
                 er = EnrollmentRequest(requestor=request.user, course=course, status="R")
                 er.save()
-                if notification:
-                    notification.send(course.active_teachers(), "course_student_request",
-                        {'creator': request.user,
-                         'course': course,
-                         'uuid': er.uuid,})
+                notices.send(course.active_teachers(), "course_student_request",
+                    {'creator': request.user,
+                     'course': course,
+                     'uuid': er.uuid,})
                 message = "Your enrollment request has been sent" 
             else:
                 course.enroll(request.user)
@@ -149,28 +330,67 @@ def enrollment(request, course_slug, action, ajax=False):
     else:
         return HttpResponseForbidden("This URI accepts the POST method only")
 
-    return _basic_response(user=request.user, ajax=ajax, message=message, 
+    return _basic_response(request, ajax=ajax, message=message, 
         redirect=request.META.get('HTTP_REFERER', reverse("course_list")))
 
 @login_required
-def enrollment_requests(request):
-    # TODO really shouldn't need two SELECTs and a list comprehension to do this!
+def enrollment_requests(request, ajax=False):
+    """
+    The enrollment requests for courses which the user actively teaches, 
+    pending ones only unless another ``status`` is given, paged by the 
+    ``after`` cursor.
+    """
+    status = request.GET.get('status', 'R')
+    if status not in dict(EnrollmentRequest.STATUS_CHOICES):
+        raise Http404
     er_list = EnrollmentRequest.objects.filter(
-        course__in=[t.course for t in 
-                    Teachership.objects.filter(teacher=request.user)]
+        course__teachership__teacher=request.user, 
+        course__teachership__is_active=True, 
+        status=status
     )
+    if ajax:
+        er_list = er_list.values(*REQUEST_LIST_FIELDS)
+    else:
+        er_list = er_list.select_related('requestor', 'course')
+    try:
+        page, next_cursor = keyset_page(er_list, 'created', 
+            after=request.GET.get('after'), limit=REQUESTS_PER_PAGE)
+    except InvalidCursor:
+        raise Http404
+    if ajax:
+        # values() rows hold natively stored keys as the raw column value
+        uuid_field = EnrollmentRequest._meta.pk
+        for row in page:
+            row['uuid'] = uuid_field.to_python(row['uuid'])
+        if ajax == 'json':
+            response = ValuesJSONResponse(page)
+        else:
+            response = ValuesXMLResponse(page, root='requests', item='request')
+        if next_cursor:
+            response['X-Next-Cursor'] = next_cursor
+        return response
     return render_to_response("courses/requests/list.html", {
-        'enrollment_requests': er_list
+        'enrollment_requests': page,
+        'next_cursor': next_cursor,
+        'status': status,
+        'pending_counts': [
+            {'course__slug': slug, 'course__title': title, 'pending': pending}
+            for slug, title, pending in Course.objects.filter(
+                teachership__teacher=request.user, 
+                teachership__is_active=True, 
+                pending_request_count__gt=0
+            ).values_list('slug', 'title', 'pending_request_count')]
     }, context_instance=RequestContext(request))  
 
 @login_required
+@commit_on_success_unless_managed
 def enrollment_response(request, enrollment_request_uuid, action, ajax=False):
     #TODO should require POST method 
     er = get_object_or_404(EnrollmentRequest, 
-                           uuid=enrollment_request_uuid, 
+                           uuid=_uuid_or_404(enrollment_request_uuid), 
                            status="R")
-    if not request.user in er.course.active_teachers():
-        return _basic_response(user=request.user, ajax=ajax, 
+    if not er.course.roles_for(request.user).is_teacher:
+        return _basic_response(request, ajax=ajax, 
             message="Only teachers of the \"%s\" course may moderate its \
                 enrollment. If you are a teacher please log in to continue." % \
                 er.course, 
@@ -189,64 +409,150 @@ def enrollment_response(request, enrollment_request_uuid, action, ajax=False):
             has been declined" % {'student': er.requestor, 'course': er.course}        
     
     er.save()
-    if notification:
-        notification.send([er.requestor], notice_type, {"course": er.course})
+    notices.send([er.requestor], notice_type, {"course": er.course})
     #TODO what happens if there is no HTTP_REFERER or notifications?
-    return _basic_response(user=request.user, ajax=ajax, message=message, 
+    return _basic_response(request, ajax=ajax, message=message, 
         redirect=request.META.get('HTTP_REFERER', reverse("notification_notices")))
 
 @login_required
+@commit_on_success_unless_managed
+def enrollment_responses(request, action, ajax=False):
+    """
+    Accepts or declines the pending enrollment requests whose UUIDs are 
+    POSTed as ``requests``, in any of the courses the user actively teaches.
+    Requests which aren't pending, or are for courses the user doesn't 
+    teach, are skipped.
+    """
+    if request.method != "POST":
+        return HttpResponseForbidden("This URI accepts the POST method only")
+    uuids = []
+    for value in request.POST.getlist(u'requests')[:MAX_BULK_RESPONSES]:
+        try:
+            value = unicode(uuid.UUID(value))
+        except ValueError:
+            continue
+        if value not in uuids:
+            uuids.append(value)
+    er_list = list(EnrollmentRequest.objects.filter(uuid__in=uuids, 
+        status="R").select_related('requestor', 'course'))
+    taught = set(Teachership.objects.filter(teacher=request.user, 
+        is_active=True, course__in=set([er.course_id for er in er_list])
+    ).values_list('course', flat=True))
+    
+    by_course = {}
+    for er in er_list:
+        if er.course_id in taught:
+            by_course.setdefault(er.course_id, []).append(er)
+    accept = action == "accept"
+    if accept:
+        notice_type = "course_student_acceptance"
+    else:
+        notice_type = "course_student_rejection"
+    batch, answered = [], {}
+    for course_id, group in by_course.items():
+        course = group[0].course
+        group = course.respond_to_requests(group, accept)
+        batch.append(([er.requestor for er in group], notice_type, 
+                      {"course": course}))
+        for er in group:
+            answered[er.uuid] = er.status
+    notices.send_many(batch)
+    
+    if accept:
+        message = "%d enrollment requests have been accepted" % len(answered)
+    else:
+        message = "%d enrollment requests have been declined" % len(answered)
+    if len(answered) < len(uuids):
+        message += ", %d could not be answered" % (len(uuids) - len(answered))
+    if ajax:
+        rows = [{'uuid': value, 'status': answered.get(value), 
+                 'answered': value in answered} for value in uuids]
+        if ajax == 'json':
+            return ValuesJSONResponse(rows)
+        return ValuesXMLResponse(rows, root='requests', item='request')
+    return _basic_response(request, message=message, 
+        redirect=request.META.get('HTTP_REFERER', 
+                                  reverse("course_enrollment_request_list")))
+
+@login_required
+@commit_on_success_unless_managed
 def teachership(request, course_slug, action, ajax=False):
     course = get_object_or_404(Course, slug=course_slug)
-    if not request.user in course.active_teachers():
-        return _basic_response(user=request.user, ajax=ajax, 
+    if not course.roles_for(request.user).is_teacher:
+        return _basic_response(request, ajax=ajax, 
             message="That action may only be performed by teachers of the \"%s\" \
                 course. If you are a teacher, please log in." % course, 
             redirect=reverse("acct_login"))
     if action == "remove":
         if request.method == 'POST':
-            if len(course.active_teachers()) <= 1:
+            if course.active_teachers().count() <= 1:
                 message = "You may not remove yourself as a teacher as you are \
                     the only one left!" % course
             else:
                 course.unappoint_teacher(request.user)
                 message="You have been removed as a teacher of the \"%s\" course" % course
-            return _basic_response(user=request.user, ajax=ajax, message=message, 
+            return _basic_response(request, ajax=ajax, message=message, 
                 redirect=request.META.get('HTTP_REFERER', course.get_absolute_url()))
         else:
             return HttpResponseForbidden("This URI accepts the POST method only")           
     elif action == "invite":
-        if not (request.user in course.owners()) and not ALLOW_TEACHER_PERMISSION_CASCADE:
-            return _basic_response(user=request.user, ajax=ajax, 
+        if not course.roles_for(request.user).is_owner and not ALLOW_TEACHER_PERMISSION_CASCADE:
+            return _basic_response(request, ajax=ajax, 
                 message="Only course owners may invite other teachers", 
                 redirect=request.META.get('HTTP_REFERER', course.get_absolute_url()))
         if request.method == "POST":
-            teachers = User.objects.filter(pk__in=request.POST.getlist(u'teachers'))
-            for teacher in teachers:                        
-                i = TeachingInvitation(invitor=request.user, invitee=teacher, course=course, 
-                    status="I")
-                i.save()
-            if notification:
-                notification.send(teachers, "course_teacher_invitation", {
-                    'creator': request.user,
-                    'course': course,
-                    'uuid': i.uuid
-                })
-            return _basic_response(user=request.user, ajax=ajax, 
+            invitations = course.invite_teachers(request.user, 
+                User.objects.filter(pk__in=request.POST.getlist(u'teachers')))
+            notices.send_many([([i.invitee], "course_teacher_invitation", {
+                'creator': request.user,
+                'course': course,
+                'uuid': i.uuid
+            }) for i in invitations])
+            return _basic_response(request, ajax=ajax, 
                 message="Your invitation has been sent", 
                 redirect=request.META.get('HTTP_REFERER', course.get_absolute_url()))
         else:
             return render_to_response("courses/courses/invite_teacher.html", {
                 'course': course,
-                'friends': [friend for friend in 
-                            friend_set_for(request.user) if not 
-                            friend in course.active_teachers()]
+                'friends': _invite_candidates(request.user, course
+                    )[:INVITE_CANDIDATES_PER_PAGE]
             }, context_instance=RequestContext(request))
 
 @login_required
+def teacher_candidates(request, course_slug, ajax='json'):
+    """
+    A typeahead of the user's friends who don't yet teach the course, 
+    filtered by the username prefix ``q`` and paged by the ``after`` cursor.
+    """
+    course = get_object_or_404(Course, slug=course_slug)
+    if not course.roles_for(request.user).is_teacher:
+        return HttpResponseForbidden("Only teachers of this course may invite \
+            other teachers")
+    candidates = _invite_candidates(request.user, course).order_by('username')
+    if request.GET.get('q'):
+        candidates = candidates.filter(username__istartswith=request.GET['q'])
+    if request.GET.get('after'):
+        candidates = candidates.filter(username__gt=request.GET['after'])
+    page = list(candidates.values(*CANDIDATE_FIELDS)[:INVITE_CANDIDATES_PER_PAGE + 1])
+    next_cursor = None
+    if len(page) > INVITE_CANDIDATES_PER_PAGE:
+        page = page[:INVITE_CANDIDATES_PER_PAGE]
+        next_cursor = page[-1]['username']
+    if ajax == 'json':
+        response = ValuesJSONResponse(page)
+    else:
+        response = ValuesXMLResponse(page, root='users', item='user')
+    if next_cursor:
+        response['X-Next-Cursor'] = next_cursor
+    return response
+
+@login_required
+@commit_on_success_unless_managed
 def teachership_response(request, teachership_invitation_uuid, action, ajax=False):
     #TODO should require POST method
-    ti = get_object_or_404(TeachingInvitation, uuid=teachership_invitation_uuid, invitee=request.user)
+    ti = get_object_or_404(TeachingInvitation, 
+                           uuid=_uuid_or_404(teachership_invitation_uuid), 
+                           invitee=request.user)
     if action == "accept":
         ti.course.appoint_teacher(request.user)
         ti.course.unenroll(request.user)
@@ -261,40 +567,59 @@ def teachership_response(request, teachership_invitation_uuid, action, ajax=Fals
         redirect = request.META.get('HTTP_REFERER', reverse("notification_notices"))
         
     ti.save()
-    if notification:
-        notification.send([ti.invitor], notice_type, {
-            "invitee": request.user,
-            "course": ti.course
-        })
-    return _basic_response(user=request.user, ajax=ajax, message=message, redirect=redirect)
+    notices.send([ti.invitor], notice_type, {
+        "invitee": request.user,
+        "course": ti.course
+    })
+    return _basic_response(request, ajax=ajax, message=message, redirect=redirect)
+
+### Instrumentation ###
+@login_required
+def query_stats(request):
+    """
+    The per-view query statistics gathered by ``QueryBudgetMiddleware`` in 
+    this process, as JSON, for staff only.
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden("Query statistics are only available to staff")
+    return JSONResponse(get_query_stats(), is_iterable=False)
 
 ### Lesson-related methods ###
 def lesson_detail(request, course_slug, lesson_slug):
     course = get_object_or_404(Course, slug=course_slug)
-    is_teacher = request.user in course.active_teachers()
-    is_student = request.user in course.active_students()
+    roles = course.roles_for(request.user)
+    is_teacher = roles.is_teacher
+    is_student = roles.is_student
     
     ACCESSIBLE = course.privacy == "P" or \
                 (course.privacy == "R" and request.user)  or \
                 (course.privacy == "E" and is_student)
                 
     if (course.activated and ACCESSIBLE) or is_teacher: 
-        lesson = get_object_or_404(Lesson, course=course, slug=lesson_slug)
+        try:
+            lesson = course.get_lesson(lesson_slug)
+        except Lesson.DoesNotExist:
+            raise Http404
         if not lesson.activated and not is_teacher:
-            if request.user:
-                request.user.message_set.create(message="This lesson has been deactivated \
-                    by a teacher, probably for maintenance. Please check back later.")
-            else: 
-                pass #should set a session message
+            feedback.add(request, "This lesson has been deactivated \
+                by a teacher, probably for maintenance. Please check back later.")
             return HttpResponseRedirect(reverse("course_list"))
-        return render_to_response("courses/lessons/lesson.html", {
+        last_modified = max(course.modified, lesson.modified)
+        etag = _viewer_etag(request, roles, 'lesson', lesson.pk, last_modified)
+        response = _not_modified(request, etag, last_modified)
+        if response:
+            return response
+        shows_feedback = feedback.pending(request)
+        response = render_to_response("courses/lessons/lesson.html", {
             "lesson": lesson,
             "is_teacher": is_teacher,
             "is_student": is_student
         }, context_instance=RequestContext(request))
+        return _set_conditional_headers(response, etag, last_modified, 
+            shows_feedback, **_cache_control(request, course, roles))
     else:
         if not course.activated:
-            request.user.message_set.create(message="This course is not yet active so can \
+            feedback.add(request, "This course is not yet active so can \
                 only be seen by course teachers. If you are a teacher of this \
                 course, please log in to view it.")
             return HttpResponseRedirect(reverse("acct_login"))
@@ -307,17 +632,14 @@ def lesson_detail(request, course_slug, lesson_slug):
                 "E": "You must be logged in and enrolled in the \"%s\" \
                     course in order to view it. If you are enrolled, please \
                     log in. "% course}
-            if request.user:
-                request.user.message_set.create(message=MESSAGE[course.privacy])
-            else: 
-                pass #should set a session message 
+            feedback.add(request, MESSAGE[course.privacy])
             return HttpResponseRedirect(course.get_absolute_url())
 
 @login_required
 def lesson(request, course_slug, lesson_slug=None):
     course = get_object_or_404(Course, slug=course_slug)
-    if not request.user in course.active_teachers():
-        request.user.message_set.create(message="That action may only be performed by \
+    if not course.roles_for(request.user).is_teacher:
+        feedback.add(request, "That action may only be performed by \
             teachers of the \"%s\" course. If you are a teacher please log in." % 
             course)
         return HttpResponseRedirect(reverse("acct_login"))
@@ -332,11 +654,11 @@ def lesson(request, course_slug, lesson_slug=None):
         if form.is_valid():
             if lesson_slug:
                 form.save()
-                request.user.message_set.create(message="Lesson changes have \
+                feedback.add(request, "Lesson changes have \
                     been saved")
             else:
                 lesson = form.save()
-                request.user.message_set.create(message="Lesson has been added")  
+                feedback.add(request, "Lesson has been added")  
             return HttpResponseRedirect(lesson.get_absolute_url())
     
     form = LessonForm(instance=lesson)
@@ -351,8 +673,8 @@ def lesson_actions(request, course_slug, lesson_slug, action, ajax=False):
     #TODO should be single query
     course = get_object_or_404(Course, slug=course_slug)
     lesson = get_object_or_404(Lesson, course=course, slug=lesson_slug)
-    if not request.user in course.active_teachers():
-        return _basic_response(user=request.user, ajax=ajax, 
+    if not course.roles_for(request.user).is_teacher:
+        return _basic_response(request, ajax=ajax, 
             message="This lesson may only be modified by teachers of the \"%s\" \
                 course. If you are a teacher please log in." % course, 
             redirect=reverse("acct_login"))
@@ -365,7 +687,7 @@ def lesson_actions(request, course_slug, lesson_slug, action, ajax=False):
             message="This lesson has now been deactivated and so may no longer \
                 be seen by users"
         lesson.save()
-        return _basic_response(user=request.user, ajax=ajax, message=message, 
+        return _basic_response(request, ajax=ajax, message=message, 
             redirect=request.META.get('HTTP_REFERER', lesson.get_absolute_url()))
     else:
         return HttpResponseForbidden("This URI only accepts the POST method")